@@ -1,46 +1,105 @@
- #!/usr/bin/env python3
+#!/usr/bin/env python3
 
+#
+# Convert leapp repository map from CSV to JSON format.
+#
+# CSV rows have 9 columns: source repoid, target repoid, target pesid,
+# source minor versions, target minor versions, architecture, repo type,
+# source channel and target channel. The first line is a header,
+# lines starting with '#' and rows with other number of columns are skipped.
+#
+
+import argparse
 import csv
 import json
+import sys
+import time
+
+
+'''
+Read rows of repository map one by one
+'''
+def read_rows(path):
+    with open(path) as csvfile:
+        reporeader = csv.reader(csvfile)
+        for row in reporeader:
+            if reporeader.line_num == 1 or not row or row[0].startswith('#'):
+                continue
+            yield row
+
+
+'''
+Build repomap structure from CSV rows.
+
+Mapping and repositories are indexed by pesid, repository entries are
+de-duplicated by their content. Everything is kept in the order of first
+appearance in the CSV, so the output is stable for the same input.
+'''
+def convert(rows, source_version, target_version, datetime):
+    mapping = {}
+    repositories = {}
+
+    for row in rows:
+        if len(row) != 9:  # the others are useless
+            continue
+        (source, target_repoid, target, _, _, arch, repo_type, source_channel, target_channel) = row
+
+        mapping.setdefault(source, {})[target] = True
+
+        for (pesid, entry) in [
+            (source, (('major_version', source_version), ('repoid', source), ('arch', arch),
+                      ('channel', source_channel), ('repo_type', repo_type))),
+            (target, (('major_version', target_version), ('repoid', target_repoid), ('arch', arch),
+                      ('channel', target_channel), ('repo_type', repo_type)))]:
+            repositories.setdefault(pesid, {})[entry] = True
+
+    mapping_entries = [{'source': source, 'target': list(targets)} for (source, targets) in mapping.items()]
+    return {
+        'datetime': datetime,
+        'version_format': '1.0.0',
+        'mapping': [{"source_major_version": source_version,
+                     "target_major_version": target_version,
+                     "entries": mapping_entries}],
+        'repositories': [{'pesid': pesid, 'entries': [dict(e) for e in entries]}
+                         for (pesid, entries) in repositories.items()],
+    }
+
+
+'''
+Generate synthetic repository map rows for benchmarking
+'''
+def synthetic_rows(count):
+    for i in range(count):
+        yield ['repo-%d' % (i % (count // 10 + 1)), 'target-%d' % (i % 1000), 'target-%d' % (i % 1000),
+               'all', 'all', ['x86_64', 'noarch', 'i686'][i % 3], ['rpm', 'srpm', 'debuginfo'][i % 3], 'ga', 'ga']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert leapp repository map from CSV to JSON")
+    parser.add_argument('-i', '--input', default='repomap.csv', help='CSV repository map (default: repomap.csv)')
+    parser.add_argument('-o', '--output', default='-', help='JSON file to write, "-" for stdout (default)')
+    parser.add_argument('--source-version', default='7', help='Source major version (default: 7)')
+    parser.add_argument('--target-version', default='8', help='Target major version (default: 8)')
+    parser.add_argument('--datetime', default=time.strftime('%Y%m%d%H%MZ', time.gmtime()), help='Timestamp of the map (default: current UTC time)')
+    parser.add_argument('--bench', type=int, metavar='ROWS', help='Convert a synthetic map with the given number of rows and print the time spent')
+    args = parser.parse_args()
+
+    if args.bench:
+        start = time.time()
+        repomap = convert(synthetic_rows(args.bench), args.source_version, args.target_version, args.datetime)
+        print("Converted %d rows (%d repositories) in %.3f seconds"
+              % (args.bench, len(repomap['repositories']), time.time() - start))
+        return 0
+
+    repomap = convert(read_rows(args.input), args.source_version, args.target_version, args.datetime)
+    if args.output == '-':
+        print(json.dumps(repomap, indent=4))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(repomap, f, indent=4)
+            f.write("\n")
+    return 0
+
 
-mapping_entries = []
-repositories = []
-
-with open('repomap.csv') as csvfile:
-    reporeader = csv.reader(csvfile)
-    for row in reporeader:
-        if len(row) == 9:  # the others are useless
-            map_found = False
-            for entry in mapping_entries:
-                if entry['source'] == row[0]:
-                    map_found = True
-                    if row[2] not in entry['target']:
-                        entry['target'].append(row[2])
-            if not map_found:
-                mapping_entries.append({'source': row[0], 'target': [row[2]]})
-
-            repo7_found = False
-            repo7_entry = {'major_version': '7', 'repoid': row[0], 'arch': row[5], 'channel': row[7], 'repo_type': row[6]}
-            for repo in repositories:
-                if repo['pesid'] == row[0]:
-                    repo7_found = True
-                    repo['entries'].append(repo7_entry)
-            if not repo7_found:
-                repositories.append({'pesid': row[0], 'entries': [repo7_entry]})
-
-            repo8_found = False
-            repo8_entry = {'major_version': '8', 'repoid': row[1], 'arch': row[5], 'channel': row[8], 'repo_type': row[6]}
-            for repo in repositories:
-                if repo['pesid'] == row[2]:
-                    repo8_found = True
-                    repo['entries'].append(repo8_entry)
-            if not repo8_found:
-                repositories.append({'pesid': row[2], 'entries': [repo8_entry]})
-
-
-for repo in repositories:
-    repo['entries'] = [dict(s) for s in set(frozenset(d.items()) for d in repo['entries'])]
-
-mapping = [{"source_major_version": "7", "target_major_version": "8", "entries": mapping_entries}]
-repomap = {'datetime': '202204020934Z', 'version_format': '1.0.0', 'mapping': mapping, 'repositories': repositories}
-print(json.dumps(repomap, indent=4))
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,29 +9,262 @@
 
 import prlsdkapi
 from prlsdkapi import consts as pc
+import os
+import json
+import shutil
 import subprocess
 import syslog
+import sys
 import time
+import concurrent.futures
 
-WAIT_TIMEOUT = 3
-MAX_RETRIES = 20
+# Max time (in seconds) we wait for dispatcher and max delay between login attempts
+DISPATCHER_TIMEOUT = 120
+MAX_RETRY_DELAY = 8
 
-attempts = 0
-while attempts < MAX_RETRIES:
+# Folder with configuration saved before the upgrade
+VZUPGRADE_DIR = '/var/lib/vzupgrade'
+
+# Max number of VEs being started at the same time
+MAX_PARALLEL_STARTS = 4
+
+# Max time (in seconds) we wait for a single VE to start
+START_TIMEOUT = 600
+
+# OS templates of containers collected by 'vzupgrade check' and the report
+# about template caches created after the upgrade
+TEMPLATES_INVENTORY = os.path.join(VZUPGRADE_DIR, 'templates.json')
+CACHE_REPORT = os.path.join(VZUPGRADE_DIR, 'template-caches.json')
+
+# Max number of template caches created at the same time and max time (in seconds)
+# given to creation of a single cache. Caches are created after VEs are started,
+# in a separate transient unit and with the idle I/O class not to slow down VEs
+MAX_PARALLEL_CACHES = 2
+CACHE_TIMEOUT = 3600
+CACHE_IONICE = ['ionice', '-c', '3']
+CACHE_UNIT = 'vzupgrade-caches'
+
+LOG_FILE = '/var/log/vzupgrade.log'
+
+
+def log(msg):
+    syslog.syslog("vzupgrade-post: " + msg)
+    with open(LOG_FILE, 'a') as f:
+        f.write(msg + "\n")
+
+
+'''
+Wait for dispatcher and log in to it.
+Login is retried with exponentially growing delays, so we don't waste
+time if dispatcher is already up. Return the server session
+'''
+def connect_dispatcher():
+    prlsdkapi.init_server_sdk()
+    server = prlsdkapi.Server()
+    deadline = time.time() + DISPATCHER_TIMEOUT
+    delay = 0.25
+    while True:
+        try:
+            server.login_local().wait()
+            return server
+        except Exception:
+            if time.time() + delay > deadline:
+                raise
+            log("Waiting for dispatcher...")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+'''
+Parse 'ip a' or 'ip link' text output, return dictionary {interface: hwaddr}
+'''
+def parse_ip_output(lines):
+    ifaces = {}
+    name = None
+    for l in lines:
+        fields = l.split()
+        if not fields:
+            continue
+        if fields[0].endswith(':') and fields[0][:-1].isdigit():
+            # VLAN interfaces are listed as 'eth0.100@eth0:'
+            name = fields[1].rstrip(':').split('@')[0]
+        elif fields[0].startswith('link/') and len(fields) > 1 and name:
+            ifaces[name] = fields[1]
+            name = None
+    return ifaces
+
+'''
+Read hwaddrs of network interfaces saved before the upgrade.
+Structured 'ip -j addr' output is used if available, older iproute
+doesn't support it so we fall back to parsing 'ip a' output.
+Return dictionary {interface: hwaddr}
+'''
+def read_saved_interfaces():
+    try:
+        with open(os.path.join(VZUPGRADE_DIR, 'iflist.json')) as f:
+            return {i['ifname']: i['address'] for i in json.load(f) if i.get('address')}
+    except (IOError, OSError, ValueError):
+        with open(os.path.join(VZUPGRADE_DIR, 'iflist')) as f:
+            return parse_ip_output(f)
+
+'''
+Build index of network interfaces present in the upgraded system.
+Return dictionary {hwaddr: [interface, ...]}
+'''
+def read_current_interfaces():
     try:
-        prlsdkapi.init_server_sdk()
-        _server = prlsdkapi.Server()
-        _server.login_local().wait()
-        break
-    except:
-        attempts += 1
-        syslog.syslog("vzupgrade-post: waiting for dispatcher...")
-        time.sleep(WAIT_TIMEOUT)
+        ifaces = {i['ifname']: i['address'] for i in json.loads(subprocess.check_output(['ip', '-j', 'link']))
+                  if i.get('address')}
+    except (subprocess.CalledProcessError, ValueError):
+        ifaces = parse_ip_output(subprocess.check_output(['ip', 'link'], universal_newlines=True).split("\n"))
+
+    by_hwaddr = {}
+    for (name, hwaddr) in ifaces.items():
+        by_hwaddr.setdefault(hwaddr, []).append(name)
+    return by_hwaddr
+
+'''
+Restore custom virtual networks saved by 'prlsrvctl net list' before the upgrade.
+Networks are bound to all interfaces with the same hwaddr as the original one,
+since interface names can change during the upgrade.
+'''
+def restore_networks():
+    net_list = os.path.join(VZUPGRADE_DIR, 'net_list')
+    if not os.path.isfile(net_list):
+        return
+
+    ifaces = read_saved_interfaces()
+    by_hwaddr = read_current_interfaces()
+    with open(net_list) as f:
+        for l in f:
+            if l.startswith("Bridged") or l.startswith("Host-Only") or l.startswith("Network ID"):
+                continue
+            fields = l.split()
+            if len(fields) < 2:
+                continue
+            (net, vtype) = fields[:2]
+            device = fields[2] if len(fields) > 2 else None
+            hwaddr = ifaces.get(device)
+            log("Trying to restore network: %s (%s : %s : %s)" % (net, vtype, device, hwaddr))
+
+            realdevs = by_hwaddr.get(hwaddr, []) if hwaddr else []
+            cmds = [['prlsrvctl', 'net', 'add', net, '-i', realdev, '-t', vtype] for realdev in realdevs]
+            if device is None:
+                cmds = [['prlsrvctl', 'net', 'add', net, '-t', vtype]]
+            for cmd in cmds:
+                proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+                if proc.stdout:
+                    log(proc.stdout.strip())
+
+'''
+Start a VE and wait for the start job to finish
+'''
+def start_ve(ve, name, since):
+    start = time.time()
+    try:
+        ve.start().wait(START_TIMEOUT * 1000)
+        result = "started"
+    except Exception as e:
+        result = "failed to start (%s)" % e
+    log("%s (%s) %s in %.1f seconds, %.1f seconds since VE start stage began"
+        % (name, ve.get_uuid(), result, time.time() - start, time.time() - since))
+
+'''
+Create (or update, if it already exists) cache of an OS template.
+Return the report entry of the template
+'''
+def create_cache(tmpl, cts):
+    start = time.time()
+    prefix = CACHE_IONICE if shutil.which(CACHE_IONICE[0]) else []
+    result = {'template': tmpl, 'containers': len(cts), 'action': None, 'status': 'failed'}
+    for action in ['create', 'update']:
+        result['action'] = action
+        try:
+            proc = subprocess.run(prefix + ['vzpkg', action, 'cache', tmpl], stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, universal_newlines=True,
+                                  timeout=max(1, CACHE_TIMEOUT - (time.time() - start)))
+        except subprocess.TimeoutExpired:
+            result['status'] = 'timeout'
+            break
+        except OSError as e:
+            log("Failed to launch vzpkg: %s" % e)
+            break
+        if proc.returncode == 0:
+            result['status'] = 'ok'
+            break
+        log("vzpkg %s cache %s failed: %s" % (action, tmpl, proc.stdout.strip()))
+    result['duration'] = round(time.time() - start, 1)
+    log("Cache of %s (%d containers): %s %s in %.1f seconds"
+        % (tmpl, len(cts), result['action'], result['status'], result['duration']))
+    return result
+
+'''
+Start creation of caches of OS templates used by containers before the upgrade.
+Return dictionary {template: future of its cache creation}
+'''
+def prewarm_caches(executor):
+    try:
+        with open(TEMPLATES_INVENTORY) as f:
+            templates = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    caches = {}
+    # Templates used by more containers go first
+    for (tmpl, cts) in sorted(templates.items(), key=lambda x: -len(x[1])):
+        if tmpl == 'unknown':
+            continue
+        caches[tmpl] = executor.submit(create_cache, tmpl, cts)
+    return caches
+
+'''
+Save report about created template caches
+'''
+def save_cache_report(caches, since):
+    with open(CACHE_REPORT, 'w') as f:
+        json.dump({'duration': round(time.time() - since, 1),
+                   'caches': [caches[tmpl].result() for tmpl in sorted(caches)]}, f, indent=4)
+    log("Template caches are ready in %.1f seconds, see %s" % (time.time() - since, CACHE_REPORT))
+
+'''
+Create caches of OS templates used by containers before the upgrade and save the report
+'''
+def build_caches():
+    since = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_CACHES) as executor:
+        caches = prewarm_caches(executor)
+    if caches:
+        save_cache_report(caches, since)
+
+'''
+Create template caches in a transient systemd unit, so that this oneshot
+service finishes without waiting for them. Without systemd-run, caches
+are created right here
+'''
+def start_cache_builds():
+    if not os.path.isfile(TEMPLATES_INVENTORY):
+        return
+    if shutil.which('systemd-run'):
+        proc = subprocess.run(['systemd-run', '--unit', CACHE_UNIT, '--description', 'VzUpgrade template caches',
+                               sys.executable, os.path.abspath(__file__), '--caches'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if proc.returncode == 0:
+            log("Template caches are created by %s.service" % CACHE_UNIT)
+            return
+        log("Failed to start %s.service: %s" % (CACHE_UNIT, proc.stdout.strip()))
+    build_caches()
+
+if sys.argv[1:] == ['--caches']:
+    build_caches()
+    sys.exit(0)
+
+_server = connect_dispatcher()
+restore_networks()
 
 flags_running = [pc.VMS_STARTING, pc.VMS_RUNNING, pc.VMS_SUSPENDING, pc.VMS_SNAPSHOTING, pc.VMS_RESETTING, pc.VMS_PAUSING, pc.VMS_CONTINUING, pc.VMS_MOUNTED]
 
 flags = pc.PVTF_VM | pc.PVTF_CT
 ves = _server.get_vm_list_ex(nFlags=flags).wait()
+to_start = []
 for ve in ves:
     if ve.is_template():
         continue
@@ -43,5 +276,21 @@ for ve in ves:
         continue
 
     # Now we have a VE which has autostart='yes' but is not running. Let's force its start
-    syslog.syslog("vzupgrade-post: Starting %s" % (ve.get_uuid()))
-    ve.start()
+    to_start.append((conf.get_auto_start_delay(), conf.get_name(), ve))
+
+# VEs are started in the order of their autostart delays, each one not earlier
+# than its delay has passed. At most MAX_PARALLEL_STARTS VEs are starting at once.
+# Running containers do not need template caches, they are created afterwards.
+to_start.sort(key=lambda x: x[0])
+since = time.time()
+with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_STARTS) as executor:
+    for (delay, name, ve) in to_start:
+        wait = since + delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        log("Starting %s (%s)" % (name, ve.get_uuid()))
+        executor.submit(start_ve, ve, name, since)
+
+log("Finished starting %d autostart VEs in %.1f seconds" % (len(to_start), time.time() - since))
+
+start_cache_builds()
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+#
+# Simulation harness and benchmark suite for vzupgrade.
+#
+# 'vzupgrade-sim.py build' creates a fake root of a VHS 7 node with the given
+# number of containers and VMs and a folder with stub platform tools (vzlist,
+# vzpkg, prlctl, prlsrvctl, yum, systemctl, leapp, rpm, ip, chkconfig,
+# modprobe, reboot). Stubs are symlinks to this script, they read the state
+# of the node from <root>/sim.json and simulate configured latencies and
+# failure rates of every command. vzupgrade works with the fake root when
+# it is launched with VZUPGRADE_ROOT=<root> and the stubs folder first in PATH.
+#
+# 'vzupgrade-sim.py bench' times check_blockers(), stop_ves(), save_configs(),
+# the whole 'check' and 'install' flows for different numbers of VEs and
+# processing of full and reduced PES events by the leapp stub, optionally
+# comparing results with a saved baseline.
+#
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Folder with vzupgrade.py and files shipped together with it
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Platform tools replaced by stubs
+STUB_TOOLS = ['vzlist', 'vzpkg', 'prlctl', 'prlsrvctl', 'yum', 'systemctl', 'leapp',
+              'rpm', 'ip', 'chkconfig', 'modprobe', 'reboot']
+
+# Default simulation parameters. Latencies (in seconds) and failure rates are
+# looked up by 'tool subcommand' first and by 'tool' then, e.g. 'prlctl stop'
+DEFAULT_CONFIG = {
+    'seed': 1,
+    'packages': 500,
+    'ct_ratio': 0.5,
+    'no_ostemplate': 0.1,
+    'suspended': 0.05,
+    'stopped': 0.1,
+    'latency': {
+        'vzpkg': 0.05,
+        'prlctl stop': 0.05,
+        'prlctl start': 0.05,
+        'prlctl list': 0.01,
+        'leapp': 1.0,
+    },
+    'failure_rate': {},
+}
+
+# Leapp phases printed by the stub
+LEAPP_PHASES = ['FactsCollection', 'Checks', 'TargetTransactionFactsCollection',
+                'TargetTransactionCheck', 'Reports']
+LEAPP_UPGRADE_PHASES = ['Download', 'InterimPreparation']
+
+# Templates assigned to simulated containers
+TEMPLATES = ['centos-7-x86_64', 'vzlinux-7-x86_64', 'ubuntu-20.04-x86_64', 'debian-10.0-x86_64']
+
+# Numbers of VEs and benchmarks launched by default
+BENCH_SIZES = [10, 100, 1000]
+BENCHMARKS = ['check_blockers', 'stop_ves', 'save_configs', 'check', 'install', 'pes_reduce', 'pes_full', 'pes_reduced']
+
+# Benchmark is reported as a regression only if it is slower than the baseline
+# by more than the given ratio and by at least REGRESSION_MIN_DELTA seconds
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_DELTA = 0.1
+
+
+'''
+Write a file creating its folder if needed
+'''
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+'''
+Generate state of a node with the given number of VEs
+'''
+def make_state(ves, config):
+    rnd = random.Random(config['seed'])
+    ncts = int(round(ves * config['ct_ratio']))
+
+    def status():
+        r = rnd.random()
+        if r < config['suspended']:
+            return 'suspended'
+        if r < config['suspended'] + config['stopped']:
+            return 'stopped'
+        return 'running'
+
+    cts = [{'ctid': '%08x-0000-4000-8000-%012x' % (i, i), 'name': 'ct%d' % i, 'status': status(),
+            'template': TEMPLATES[i % len(TEMPLATES)], 'in_config': rnd.random() >= config['no_ostemplate']}
+           for i in range(ncts)]
+    vms = [{'name': 'vm %d' % i, 'status': status()} for i in range(ves - ncts)]
+    packages = [['package-%d' % i, 0, '1.%d' % (i % 10), '1.vz7', ['x86_64', 'noarch'][i % 2], 10240 * (i % 100 + 1)]
+                for i in range(config['packages'])]
+
+    state = dict(config)
+    state.update({'cts': cts, 'vms': vms, 'rpms': packages})
+    return state
+
+'''
+Create yum sqlite metadata cache of a repository with the given packages
+'''
+def write_repo_cache(path, packages):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT, "
+               "version TEXT, epoch TEXT, release TEXT, size_package INTEGER, size_installed INTEGER, "
+               "location_href TEXT, checksum_type TEXT)")
+    db.executemany("INSERT INTO packages (pkgId, name, arch, version, epoch, release, size_package, "
+                   "size_installed, location_href, checksum_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   [("%064x" % i, name, arch, ver, str(epoch), rel, size // 3, size,
+                     "Packages/%s-%s-%s.%s.rpm" % (name, ver, rel, arch), 'sha256')
+                    for (i, (name, epoch, ver, rel, arch, size)) in enumerate(packages)])
+    db.commit()
+    db.close()
+
+'''
+Create fake root of a node with the given state
+'''
+def build_root(root, state):
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    # vzupgrade files
+    share = os.path.join(root, 'usr/share/vzupgrade')
+    os.makedirs(os.path.join(share, 'pre-check'))
+    os.makedirs(os.path.join(share, 'pre-install'))
+    for f in ['vz8.repo', 'vz8_dummy.repo', 'vzlinux8.repo', 'vz9.repo', 'vz9_dummy.repo', 'vzlinux9.repo',
+              'templates-vz8.json', 'templates-vz9.json']:
+        shutil.copy(os.path.join(SRC_DIR, f), share)
+
+    # Leapp data
+    leapp_files = os.path.join(root, 'etc/leapp/files')
+    os.makedirs(leapp_files)
+    os.makedirs(os.path.join(root, 'etc/leapp/answers'))
+    for f in ['answerfile', 'answerfile.userchoices']:
+        shutil.copy(os.path.join(SRC_DIR, f), os.path.join(root, 'etc/leapp/answers'))
+    shutil.copy(os.path.join(SRC_DIR, 'device_driver_deprecation_data.json'), leapp_files)
+    for suf in ['8', '9']:
+        shutil.copy(os.path.join(SRC_DIR, 'repomap-vz%s.csv' % suf), leapp_files)
+        events = [{'id': i, 'action': 3,
+                   'in_packageset': {'package': [{'name': p[0], 'repository': 'base'}]},
+                   'out_packageset': {'package': [{'name': p[0] + '-ng', 'repository': 'vzlinux' + suf}]}}
+                  for (i, p) in enumerate(state['rpms'])]
+        events += [{'id': len(events) + i, 'action': 1,
+                    'in_packageset': {'package': [{'name': 'absent-%d' % i, 'repository': 'base'}]},
+                    'out_packageset': None}
+                   for i in range(len(state['rpms']))]
+        with open(os.path.join(leapp_files, 'pes-events-vz%s.json' % suf), 'w') as f:
+            json.dump({'packageinfo': events}, f)
+
+    # System configuration
+    write_file(os.path.join(root, 'etc/ssh/sshd_config'),
+               "Port 22\nPermitRootLogin yes\nPasswordAuthentication yes\n"
+               "GSSAPIAuthentication yes\nUsePrivilegeSeparation sandbox\n"
+               "Subsystem sftp /usr/libexec/openssh/sftp-server\n")
+    for i in range(200):
+        write_file(os.path.join(root, 'etc/sim/conf-%d' % i), "option%d = value\n" % i * 20)
+    write_file(os.path.join(root, 'etc/yum.repos.d/virtuozzo.repo'),
+               "[virtuozzo-os]\nname=Virtuozzo\nbaseurl=http://repo.virtuozzo.com/vz/releases/7.0/x86_64/os/\nenabled=1\n")
+    write_repo_cache(os.path.join(root, 'var/cache/yum/x86_64/7/virtuozzo-os/gen/primary_db.sqlite'), state['rpms'])
+    write_repo_cache(os.path.join(root, 'var/cache/yum/x86_64/7/vzlinux8/gen/primary_db.sqlite'),
+                     [[name, epoch, ver, '1.vl8', arch, size * 2] for (name, epoch, ver, rel, arch, size) in state['rpms']])
+    write_file(os.path.join(root, 'var/lib/rpm/Packages'), "%d packages\n" % len(state['rpms']))
+
+    # Containers
+    for ct in state['cts']:
+        conf = 'VE_ROOT="/vz/root/$VEID"\nVE_PRIVATE="/vz/private/$VEID"\n'
+        if ct['in_config']:
+            conf += 'OSTEMPLATE=".%s"\n' % ct['template']
+        write_file(os.path.join(root, 'etc/vz/conf', ct['ctid'] + '.conf'), conf)
+
+    # Hardware
+    for (i, (vendor, device, driver)) in enumerate([('0x8086', '0x10d3', 'e1000e'), ('0x8086', '0x2922', 'ahci'),
+                                                    ('0x15b3', '0x1003', 'mlx4_core')]):
+        dev = os.path.join(root, 'sys/bus/pci/devices/0000:00:%02x.0' % i)
+        write_file(os.path.join(dev, 'vendor'), vendor + "\n")
+        write_file(os.path.join(dev, 'device'), device + "\n")
+        os.symlink('../../../bus/pci/drivers/' + driver, os.path.join(dev, 'driver'))
+    write_file(os.path.join(root, 'proc/modules'),
+               "".join("%s 16384 0 - Live 0x0000000000000000\n" % m for m in ['e1000e', 'ahci', 'ext4', 'kvm']))
+
+    with open(os.path.join(root, 'sim.json'), 'w') as f:
+        json.dump(state, f)
+
+'''
+Create folder with stub tools pointing to this script
+'''
+def build_stubs(bindir):
+    os.makedirs(bindir, exist_ok=True)
+    for tool in STUB_TOOLS:
+        path = os.path.join(bindir, tool)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(os.path.abspath(__file__), path)
+
+'''
+Get environment for vzupgrade working with the fake root
+'''
+def sim_env(root, bindir):
+    env = dict(os.environ)
+    env['VZUPGRADE_ROOT'] = root
+    env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+    return env
+
+
+'''
+Output of a stub tool for the given arguments.
+Return exit code and output
+'''
+def stub_output(tool, args, state, root):
+    ves = [(ct['status'], ct['name']) for ct in state['cts']] + [(vm['status'], vm['name']) for vm in state['vms']]
+
+    if tool == 'vzlist':
+        return 0, "".join("%s\n" % ct['ctid'] for ct in state['cts'])
+    if tool == 'vzpkg' and args[:1] == ['list']:
+        for ct in state['cts']:
+            if ct['ctid'] == args[1]:
+                return 0, ct['template'] + "\n"
+        return 1, ""
+    if tool == 'prlctl' and args[:1] == ['list']:
+        return 0, "STATUS       NAME\n" + "".join("%-12s %s\n" % ve for ve in ves)
+    if tool == 'prlctl' and args[:1] in [['start'], ['stop']]:
+        return (0 if args[1] in [ve[1] for ve in ves] else 1), ""
+    if tool == 'prlsrvctl':
+        return 0, "Network ID        Type      Bound To\nHost-Only         host-only\nBridged           bridged   br0\n"
+    if tool == 'systemctl':
+        return 3, "inactive\n"
+    if tool == 'rpm':
+        return 0, "".join("%s %d %s %s %s %d\n" % tuple(p) for p in state['rpms'])
+    if tool == 'ip' and '-j' in args:
+        return 0, json.dumps([{'ifindex': 1, 'ifname': 'br0', 'address': '52:54:00:12:34:56',
+                               'addr_info': [{'family': 'inet', 'local': '10.0.0.2', 'prefixlen': 24}]}]) + "\n"
+    if tool == 'ip':
+        return 0, "1: br0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n    link/ether 52:54:00:12:34:56\n    inet 10.0.0.2/24\n"
+    if tool == 'chkconfig':
+        return 0, "network        0:off 1:off 2:on 3:on 4:on 5:on 6:off\n"
+    return 0, ""
+
+'''
+Apply PES events to the installed packages the way leapp does: an event
+applies if all its input packages are present, they are then replaced by
+its output packages. Return the number of applied events
+'''
+def process_pes_events(path, installed):
+    with open(path) as f:
+        events = json.load(f)['packageinfo']
+
+    packages = set(installed)
+    applied = 0
+    for e in events:
+        names = [p['name'] for p in ((e.get('in_packageset') or {}).get('package') or [])]
+        if not all(n in packages for n in names):
+            continue
+        packages.difference_update(names)
+        packages.update(p['name'] for p in ((e.get('out_packageset') or {}).get('package') or []))
+        applied += 1
+    return applied
+
+'''
+Simulate leapp run: process PES events, print phases and actors spreading
+the latency over them and save the report
+'''
+def stub_leapp(args, latency, root, state):
+    pes_events = os.path.join(root, 'etc/leapp/files/pes-events.json')
+    if os.path.isfile(pes_events):
+        process_pes_events(pes_events, [p[0] for p in state['rpms']])
+
+    phases = LEAPP_PHASES + (LEAPP_UPGRADE_PHASES if args[:1] == ['upgrade'] else [])
+    for phase in phases:
+        print("==> Processing phase `%s`" % phase)
+        for actor in range(3):
+            print("====> * %s_actor_%d" % (phase.lower(), actor))
+            sys.stdout.flush()
+            time.sleep(latency / len(phases) / 3)
+    write_file(os.path.join(root, 'var/log/leapp/leapp-report.txt'), "Upgrade has been simulated\n")
+    return 0
+
+'''
+Entry point of stub tools
+'''
+def run_stub(tool, args):
+    root = os.environ.get('VZUPGRADE_ROOT', '/')
+    with open(os.path.join(root, 'sim.json')) as f:
+        state = json.load(f)
+
+    key = "%s %s" % (tool, args[0]) if args else tool
+    latency = state['latency'].get(key, state['latency'].get(tool, 0))
+    failure_rate = state['failure_rate'].get(key, state['failure_rate'].get(tool, 0))
+
+    # Failures are reproducible: the same command always fails or succeeds
+    if random.Random("%s %s %s" % (state['seed'], tool, " ".join(args))).random() < failure_rate:
+        time.sleep(latency)
+        sys.stderr.write("%s: simulated failure\n" % tool)
+        return 1
+
+    if tool == 'leapp':
+        return stub_leapp(args, latency, root, state)
+
+    time.sleep(latency)
+    (ret, out) = stub_output(tool, args, state, root)
+    sys.stdout.write(out)
+    return ret
+
+
+'''
+Load a fresh copy of vzupgrade module working with the given root.
+Return the module and its options for the given arguments
+'''
+def load_vzupgrade(root, bindir, args):
+    os.environ.update(sim_env(root, bindir))
+    spec = importlib.util.spec_from_file_location('vzupgrade', os.path.join(SRC_DIR, 'vzupgrade.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, module.parse_command_line(args)
+
+'''
+PES events benchmarks: 'pes_reduce' times reduce_pes_events() alone (its result
+is cached by rpmdb state), 'pes_full' and 'pes_reduced' time processing of the
+full and the reduced events files by the leapp stub
+'''
+def run_pes_benchmark(name, root, bindir):
+    saved = dict(os.environ)
+    try:
+        (module, opts) = load_vzupgrade(root, bindir, ['check'])
+        installed = [p[0] for p in module.read_rpmdb()]
+        full = os.path.join(module.LEAPP_FILES_DIR, 'pes-events-vz8.json')
+        reduced = os.path.join(module.LEAPP_FILES_DIR, 'pes-events-vz8-reduced.json')
+        if name != 'pes_reduce':
+            module.reduce_pes_events(full, reduced, installed)
+
+        start = time.time()
+        if name == 'pes_reduce':
+            module.reduce_pes_events(full, reduced, installed)
+        else:
+            process_pes_events(full if name == 'pes_full' else reduced, installed)
+        return time.time() - start, 0
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+'''
+Run a single benchmark, return the time spent and the exit code
+'''
+def run_benchmark(name, root, bindir):
+    if name in ['pes_reduce', 'pes_full', 'pes_reduced']:
+        return run_pes_benchmark(name, root, bindir)
+
+    if name in ['check', 'install']:
+        args = ['check', '--force'] if name == 'check' else ['install']
+        start = time.time()
+        ret = subprocess.call([sys.executable, os.path.join(SRC_DIR, 'vzupgrade.py')] + args,
+                              env=sim_env(root, bindir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.time() - start, ret
+
+    saved = dict(os.environ)
+    try:
+        (module, opts) = load_vzupgrade(root, bindir, ['install'])
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            start = time.time()
+            ret = getattr(module, name)(opts)
+            return time.time() - start, ret
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+'''
+Read simulation config, parameters from the given file override the defaults
+'''
+def read_config(path):
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if path:
+        with open(path) as f:
+            custom = json.load(f)
+        for (k, v) in custom.items():
+            if isinstance(v, dict):
+                config[k].update(v)
+            else:
+                config[k] = v
+    return config
+
+def build(args):
+    config = read_config(args.config)
+    build_root(os.path.abspath(args.root), make_state(args.ves, config))
+    build_stubs(os.path.abspath(args.bin))
+    print("Simulated node with %d VEs created in %s, stubs are in %s" % (args.ves, args.root, args.bin))
+    print("Launch vzupgrade as: VZUPGRADE_ROOT=%s PATH=%s:$PATH %s/vzupgrade.py check"
+          % (os.path.abspath(args.root), os.path.abspath(args.bin), SRC_DIR))
+    return 0
+
+def bench(args):
+    config = read_config(args.config)
+    workdir = tempfile.mkdtemp(prefix='vzupgrade-sim-')
+    bindir = os.path.join(workdir, 'bin')
+    build_stubs(bindir)
+
+    results = []
+    try:
+        for ves in args.ves:
+            state = make_state(ves, config)
+            for name in args.bench:
+                times = []
+                for i in range(args.repeat):
+                    # Every run starts from a clean node
+                    root = os.path.join(workdir, 'root')
+                    build_root(root, state)
+                    (duration, ret) = run_benchmark(name, root, bindir)
+                    times.append(duration)
+                result = {'benchmark': name, 'ves': ves, 'seconds': round(sorted(times)[len(times) // 2], 3),
+                          'min': round(min(times), 3), 'exit_code': ret}
+                results.append(result)
+                if not args.json:
+                    print("%-16s %6d VEs  %8.3f s (min %.3f s)  exit code %s"
+                          % (name, ves, result['seconds'], result['min'], ret))
+                    sys.stdout.flush()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print("Simulated node is kept in %s" % workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = {(r['benchmark'], r['ves']): r['seconds'] for r in json.load(f)}
+    regressions = 0
+    for r in results:
+        old = baseline.get((r['benchmark'], r['ves']))
+        if old is None:
+            continue
+        if r['seconds'] > old * (1 + args.threshold) and r['seconds'] - old >= REGRESSION_MIN_DELTA:
+            regressions += 1
+            print("REGRESSION: %s with %d VEs: %.3f s, baseline %.3f s"
+                  % (r['benchmark'], r['ves'], r['seconds'], old), file=sys.stderr)
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate VHS 7 node and benchmark vzupgrade on it")
+    subparsers = parser.add_subparsers(title='command')
+
+    sp = subparsers.add_parser('build', help='Create fake root and stub tools of a simulated node')
+    sp.add_argument('--root', required=True, help='Folder for the fake root')
+    sp.add_argument('--bin', required=True, help='Folder for the stub tools')
+    sp.add_argument('--ves', type=int, default=10, help='Number of simulated VEs (default: 10)')
+    sp.add_argument('--config', action='store', help='JSON file with simulation parameters: latency and failure_rate per command, packages, ct_ratio, etc.')
+    sp.set_defaults(func=build)
+
+    sp = subparsers.add_parser('bench', help='Benchmark vzupgrade on simulated nodes')
+    sp.add_argument('--ves', type=int, nargs='+', default=BENCH_SIZES, help='Numbers of VEs to simulate (default: %s)' % " ".join(map(str, BENCH_SIZES)))
+    sp.add_argument('--bench', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run (default: all)')
+    sp.add_argument('--repeat', type=int, default=1, help='Number of runs of every benchmark, the median is reported (default: 1)')
+    sp.add_argument('--config', action='store', help='JSON file with simulation parameters')
+    sp.add_argument('--json', action='store_true', help='Print results in JSON format')
+    sp.add_argument('--save', action='store', metavar='FILE', help='Save results to FILE to be used as a baseline later')
+    sp.add_argument('--baseline', action='store', metavar='FILE', help='Compare results with the saved ones, exit code is 1 if regressions are found')
+    sp.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='Slowdown ratio considered as a regression (default: %.2f)' % REGRESSION_THRESHOLD)
+    sp.add_argument('--keep', action='store_true', help='Keep the last simulated node for inspection')
+    sp.set_defaults(func=bench)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    tool = os.path.basename(sys.argv[0])
+    if tool in STUB_TOOLS:
+        sys.exit(run_stub(tool, sys.argv[1:]))
+    sys.exit(main())
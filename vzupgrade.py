@@ -15,76 +15,455 @@ import os
 import time
 import shutil
 import re
-import fileinput
 import glob
+import json
+import fnmatch
+import shlex
+import hashlib
+import threading
+import functools
+import contextlib
+import collections
+import concurrent.futures
 from shutil import copyfile
 
+# Modules needed only by some commands (pickle, configparser, sqlite3, gzip,
+# xml.etree, urllib, ctypes, socket) are imported by the functions using them, so that the
+# CLI starts faster and the module is cheap to import as a library
+
+# Root of the managed system, other roots are used by the simulation harness
+ROOT = os.environ.get('VZUPGRADE_ROOT', '/')
+
+'''
+Get path of a file of the managed system
+'''
+def host_path(path):
+    return os.path.join(ROOT, path.lstrip('/'))
+
 # Partition with /var/lib folder should have at least MIN_FREE_GB free gigabytes
 MIN_FREE_GB = 3
 
+# Space (in megabytes) needed by leapp target userspace container (without
+# downloaded packages) and by new kernel and initramfs images in /boot
+LEAPP_USERSPACE_MB = 1024
+BOOT_REQUIRED_MB = 200
+
+# If a package is not found in cached target metadata, we assume that its
+# download size is DOWNLOAD_RATIO of its installed size
+DOWNLOAD_RATIO = 0.35
+
 # Folders with custom pre-install and pre-check scripts
-PRECHECK_DIR='/usr/share/vzupgrade/pre-check'
-PREINST_DIR='/usr/share/vzupgrade/pre-install'
+PRECHECK_DIR = host_path('/usr/share/vzupgrade/pre-check')
+PREINST_DIR = host_path('/usr/share/vzupgrade/pre-install')
+
+# Max number of hooks launched in parallel and default max run time (in seconds) of a hook
+HOOK_JOBS = 4
+HOOK_TIMEOUT = 600
+
+# Folder with files shipped with vzupgrade
+VZUPGRADE_SHARE_DIR = host_path('/usr/share/vzupgrade')
+
+# Files and folders of the managed system modified or inspected by vzupgrade
+ETC_DIR = host_path('/etc')
+SSHD_CONFIG = host_path('/etc/ssh/sshd_config')
+RPMDB_DIR = host_path('/var/lib/rpm')
+
+# Folder where vzupgrade keeps saved configuration and its own state
+VZUPGRADE_DIR = host_path('/var/lib/vzupgrade')
+
+# Folder with leapp data files, answer files and reports
+LEAPP_FILES_DIR = host_path('/etc/leapp/files')
+LEAPP_ANSWERS_DIR = host_path('/etc/leapp/answers')
+LEAPP_LOG_DIR = host_path('/var/log/leapp')
+LEAPP_REPORTS = ['leapp-report.txt', 'leapp-report.json']
+
+# Durations of leapp phases in previous runs, used to estimate remaining time
+LEAPP_TIMINGS = os.path.join(VZUPGRADE_DIR, 'leapp-timings.json')
+
+# Current progress of leapp for monitoring tools
+STATUS_FILE = host_path('/run/vzupgrade/status.json')
+
+# Fingerprint and leapp reports of the last successful 'check'
+CHECK_CACHE_DIR = os.path.join(VZUPGRADE_DIR, 'check-cache')
+
+# Folder with container configs, used to get OS templates without launching vzpkg
+VZ_CONF_DIR = host_path('/etc/vz/conf')
+
+# Max number of vzpkg processes launched in parallel
+TEMPLATE_JOBS = 8
+
+# OS templates of containers collected by the last check, vzupgrade-post-ves
+# uses them to create template caches after the upgrade
+TEMPLATES_INVENTORY = os.path.join(VZUPGRADE_DIR, 'templates.json')
+
+# OS templates supported by the target release (vz8 or vz9), see load_template_policy()
+TEMPLATE_POLICY = os.path.join(VZUPGRADE_SHARE_DIR, 'templates-vz%s.json')
+TEMPLATE_POLICY_FORMAT = 1
+
+# Data about devices and drivers deprecated or removed in new releases, shared with leapp
+DEVICE_DATA_FILE = host_path('/etc/leapp/files/device_driver_deprecation_data.json')
+DEVICE_DATA_CACHE = os.path.join(VZUPGRADE_DIR, 'device_driver_deprecation_data.pickle')
+
+# Sources of information about present hardware and loaded drivers
+SYSFS_PCI_DIR = host_path('/sys/bus/pci/devices')
+PROC_MODULES = host_path('/proc/modules')
+
+# Trace of phases and external commands of all runs, in JSON lines format
+TRACE_DIR = host_path('/var/log/vzupgrade')
+TRACE_FILE = os.path.join(TRACE_DIR, 'trace.jsonl')
+
+# Output of every hook is saved here
+HOOK_LOG_DIR = os.path.join(TRACE_DIR, 'hooks')
+
+# Max time (in seconds) we wait for 'yum check-update'
+YUM_TIMEOUT = 600
+
+# yum repository configs and metadata caches of yum and dnf
+YUM_REPOS_DIR = host_path('/etc/yum.repos.d')
+YUM_CONF = host_path('/etc/yum.conf')
+YUM_PRIORITIES_CONF = host_path('/etc/yum/pluginconf.d/priorities.conf')
+
+# Priority of repositories without 'priority' option, as in yum-plugin-priorities
+YUM_DEFAULT_PRIORITY = 99
+YUM_CACHE_DIR = host_path('/var/cache/yum')
+DNF_CACHE_DIR = host_path('/var/cache/dnf')
+
+# Local mirror of target packages downloaded by 'vzupgrade prefetch' and the repo file pointing to it
+PREFETCH_DIR = host_path('/var/cache/vzupgrade/prefetch')
+PREFETCH_REPO_FILE = os.path.join(YUM_REPOS_DIR, 'vzupgrade-prefetch.repo')
+
+# Default number of parallel downloads
+PREFETCH_JOBS = 8
+
+# Package from repository metadata
+RepoPackage = collections.namedtuple('RepoPackage', ['name', 'arch', 'epoch', 'version', 'release',
+                                                     'size_package', 'size_installed',
+                                                     'location', 'checksum_type', 'checksum'])
+
+# Default number of VEs stopped in parallel before the upgrade
+STOP_JOBS = 8
+
+# Default time (in seconds) given to a VE to stop gracefully before it is killed
+# and max time (in seconds) given to the kill
+STOP_TIMEOUT = 300
+KILL_TIMEOUT = 60
+
+# Default number of nodes processed in parallel by 'vzupgrade fleet'
+FLEET_JOBS = 10
 
+# Output of vzupgrade on every node and fleet reports are saved here, per run
+FLEET_LOG_DIR = os.path.join(TRACE_DIR, 'fleet')
+
+# Number of last output lines of a node included into the fleet report
+FLEET_TAIL_LINES = 10
+
+# vzupgrade arguments for every fleet action. Blockers are always reported
+# in JSON, so the report gets them in a structured form
+FLEET_ACTIONS = {
+    'blocker': ['check', '--blocker', '--format', 'json'],
+    'check': ['check', '--format', 'json'],
+    'install': ['install', '--format', 'json'],
+}
+
+# Blocker state maintained by 'vzupgrade watch' is served from these file and socket
+WATCH_STATUS_FILE = host_path('/run/vzupgrade/blockers.json')
+WATCH_SOCKET = host_path('/run/vzupgrade/watch.sock')
+
+# systemd creates 'invocation:<unit>' links here when units start and removes them when units stop
+SYSTEMD_UNITS_DIR = host_path('/run/systemd/units')
+
+# Checks which 'vzupgrade watch' re-runs periodically (every WATCH_INTERVAL seconds)
+# because their inputs can't be watched: disk usage, states of services and
+# target metadata, whose prefetch folders may not exist yet
+WATCH_POLLED = ['space', 'target_metadata', 'va', 'storage_ui']
+WATCH_INTERVAL = 300
+
+# Checks are re-run once watched folders have not changed for WATCH_DEBOUNCE seconds,
+# so that e.g. a whole rpm transaction leads to a single re-run
+WATCH_DEBOUNCE = 2
+
+# inotify(7) events meaning that something in a folder has changed
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
 
 '''
-Check if sshd_config has explicit PermitRootLogin. Set to 'yes' if it doesn't.
+Upgrade blocker check.
 
-The problem is that default is different in Vz7 and Vz8.
+severity - 'error' blocks the upgrade, 'warning' is only reported
+timeout - max time (in seconds) the check is allowed to run
+vz_only - the check is skipped when --skip-vz is specified
+func - function taking options and returning a list of messages describing
+       found problems, empty list means that everything is fine
+'''
+Blocker = collections.namedtuple('Blocker', ['name', 'severity', 'timeout', 'vz_only', 'func'])
+
+# All registered blockers, in the order of registration
+BLOCKERS = []
 
-In addition, comment out the ciphers section - it can contain
-old algorithms used for migrating VMs from Vz6 to Vz7
 '''
-def fix_sshd_config():
-    # First, comment out ciphers
-    with fileinput.input(files=('/etc/ssh/sshd_config'), inplace=True) as f:
-        for l in f:
-            if l.startswith("ciphers "):
-                l = '# ' + l
-            print(l.strip())
+Decorator registering a function as an upgrade blocker check
+'''
+def register_blocker(name, severity='error', timeout=60, vz_only=False):
+    def wrapper(func):
+        BLOCKERS.append(Blocker(name, severity, timeout, vz_only, func))
+        return func
+    return wrapper
+
+# Identifier of the current run in the trace
+trace_run = "%s-%d" % (time.strftime('%Y%m%d%H%M%S'), os.getpid())
+trace_lock = threading.Lock()
+# Set by long-running commands (watch) which must not flood the trace
+trace_disabled = threading.Event()
+
+# Deadline of the task run by the current thread (e.g. a blocker check),
+# commands launched by traced_run() are killed when it is reached
+task_deadline = threading.local()
 
-    # Check if we already have explicit PrintMotd
-    need_motd_fix = True
-    with open("/etc/ssh/sshd_config") as f:
-        for l in f:
-            if l.strip().startswith("PrintMotd"):
-                need_motd_fix = False
-                break
+'''
+Append an event to the trace file.
+Tracing must never break the upgrade, so all write errors are ignored
+'''
+def trace_event(kind, name, start, status, **extra):
+    if trace_disabled.is_set():
+        return
+    event = {'run': trace_run, 'type': kind, 'name': name, 'start': round(start, 6),
+             'duration': round(time.time() - start, 6), 'status': status,
+             'pid': os.getpid(), 'tid': threading.get_ident()}
+    event.update(extra)
+    with trace_lock:
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            with open(TRACE_FILE, 'a') as f:
+                f.write(json.dumps(event) + "\n")
+        except (IOError, OSError):
+            pass
 
-    if need_motd_fix:
-        with fileinput.input(files=('/etc/ssh/sshd_config'), inplace=True) as f:
-            for l in f:
-                # default config in Vz7 should have commented PrintMotd
-                if l.strip().startswith("#PrintMotd"):
-                    print("PrintMotd no")
-                print(l.strip())
+'''
+Decorator recording start, duration and result of a pipeline phase in the trace
+'''
+def traced_phase(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        status = 'exception'
+        try:
+            ret = func(*args, **kwargs)
+            status = ret if isinstance(ret, int) else 0
+            return ret
+        finally:
+            trace_event('phase', func.__name__, start, status)
+    return wrapper
 
-    # Check if we already have explicit PermitRootLogin
-    with open("/etc/ssh/sshd_config") as f:
-        for l in f:
-            if l.strip().startswith("PermitRootLogin"):
-                return
+'''
+Decorator for commands with '--format json': only the JSON report goes to
+stdout (opts.json_stream), all other output of the command goes to stderr
+'''
+def json_stdout(func):
+    @functools.wraps(func)
+    def wrapper(opts, *args, **kwargs):
+        if getattr(opts, 'format', 'text') != 'json':
+            return func(opts, *args, **kwargs)
+        opts.json_stream = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            return func(opts, *args, **kwargs)
+    return wrapper
 
-    # If we are here, we have to set explici parameter
-    modified = False
-    with fileinput.input(files=('/etc/ssh/sshd_config'), inplace=True) as f:
-        for l in f:
-            if not modified and "PermitRootLogin" in l:
-                print("PermitRootLogin yes")
-                modified = True
-            print(l.strip())
+'''
+Popen which collects resource usage of the child when reaping it.
+The child is reaped by os.wait4() in wait(), which is also used by
+communicate() and the context manager
+'''
+class TracedPopen(subprocess.Popen):
+    rusage = None
+
+    def wait(self, timeout=None):
+        if self.returncode is not None:
+            return self.returncode
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        while True:
+            try:
+                (pid, sts, rusage) = os.wait4(self.pid, 0 if deadline is None else os.WNOHANG)
+            except ChildProcessError:
+                # Already reaped elsewhere, the exit status is lost
+                self.returncode = 0
+                return self.returncode
+            if pid:
+                self.rusage = rusage
+                self.returncode = -os.WTERMSIG(sts) if os.WIFSIGNALED(sts) else os.WEXITSTATUS(sts)
+                return self.returncode
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
 
-    if modified:
+'''
+Record a finished (or failed to start) command in the trace
+'''
+def trace_command(cmd, start, status, proc=None):
+    if isinstance(cmd, str):
+        cmd = [cmd]
+    extra = {'cmd': cmd}
+    if proc is not None and proc.rusage is not None:
+        extra.update({'child_pid': proc.pid,
+                      'cpu_user': round(proc.rusage.ru_utime, 6),
+                      'cpu_sys': round(proc.rusage.ru_stime, 6),
+                      'maxrss_kb': proc.rusage.ru_maxrss})
+    trace_event('command', " ".join([os.path.basename(cmd[0])] + cmd[1:2]), start, status, **extra)
+
+'''
+Kill a command. A command started in its own session (start_new_session=True)
+is killed together with all processes of its group
+'''
+def kill_command(proc, session):
+    import signal
+    if not session:
+        proc.kill()
         return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
 
-    # If we are here then we haven't find a place to add our line
-    # Let's add it somewhere in the beginning then
-    with fileinput.input(files=('/etc/ssh/sshd_config')) as f:
-        for l in f:
-            if not modified and not l.strip().startswith('#') and l.strip():
-                print("PermitRootLogin yes")
-                modified = True
-            print(l)
+'''
+Traced analog of subprocess.run() without 'check' and 'input' support
+'''
+def traced_run(cmd, timeout=None, **kwargs):
+    start = time.time()
+    deadline = getattr(task_deadline, 'value', None)
+    if deadline is not None:
+        left = max(0.1, deadline - start)
+        timeout = left if timeout is None else min(timeout, left)
+    try:
+        proc = TracedPopen(cmd, **kwargs)
+    except OSError as e:
+        trace_command(cmd, start, str(e))
+        raise
+
+    with proc:
+        try:
+            (out, err) = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_command(proc, kwargs.get('start_new_session'))
+            proc.communicate()
+            trace_command(cmd, start, 'timeout', proc)
+            raise
+        except:
+            kill_command(proc, kwargs.get('start_new_session'))
+            proc.wait()
+            trace_command(cmd, start, 'interrupted', proc)
+            raise
+    trace_command(cmd, start, proc.returncode, proc)
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+'''
+Traced analogs of call() and check_output()
+'''
+def traced_call(cmd, **kwargs):
+    return traced_run(cmd, **kwargs).returncode
+
+def traced_check_output(cmd, **kwargs):
+    proc = traced_run(cmd, stdout=subprocess.PIPE, **kwargs)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, proc.stdout)
+    return proc.stdout
+
+
+'''
+Rewrite a config file in a single pass.
+
+The file is read once into a list of lines (with line endings) and every
+fixup is applied to it in turn. A fixup modifies the list in place and
+returns True if it has changed anything. The file is replaced atomically
+(temporary file + rename) and only if some fixup has changed it.
+
+Return True if the file was modified
+'''
+def edit_config(path, fixups):
+    with open(path) as f:
+        lines = f.readlines()
+
+    changed = False
+    for fixup in fixups:
+        if fixup(lines):
+            changed = True
+    if not changed:
+        return False
+
+    st = os.stat(path)
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        os.chmod(tmp, st.st_mode)
+        os.chown(tmp, st.st_uid, st.st_gid)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    return True
+
+'''
+Build a fixup commenting out all lines with the given option (case-insensitive)
+'''
+def comment_out_option(name):
+    def fixup(lines):
+        changed = False
+        for i, l in enumerate(lines):
+            if l.lower().startswith(name.lower() + " "):
+                lines[i] = '# ' + l
+                changed = True
+        return changed
+    return fixup
+
+'''
+Build a fixup setting explicit option value if the option is not set yet.
+
+The line is added just before the first line containing 'anchor'.
+If there is no such line and 'fallback' is True, the line is added before
+the first non-comment line (or to the end of an empty file)
+'''
+def ensure_option(name, value, anchor, fallback=False):
+    def fixup(lines):
+        for l in lines:
+            if l.strip().startswith(name):
+                return False
+
+        idx = next((i for i, l in enumerate(lines) if anchor in l), None)
+        if idx is None and fallback:
+            idx = next((i for i, l in enumerate(lines) if l.strip() and not l.strip().startswith('#')), len(lines))
+        if idx is None:
+            return False
+
+        lines.insert(idx, "%s %s\n" % (name, value))
+        return True
+    return fixup
+
+'''
+Check if sshd_config has explicit PermitRootLogin. Set to 'yes' if it doesn't.
+
+The problem is that default is different in Vz7 and Vz8.
+
+In addition, comment out the ciphers section - it can contain
+old algorithms used for migrating VMs from Vz6 to Vz7
+'''
+def fix_sshd_config():
+    edit_config(SSHD_CONFIG, [
+        comment_out_option("ciphers"),
+        # default config in Vz7 should have commented PrintMotd
+        ensure_option("PrintMotd", "no", "#PrintMotd"),
+        # If there is no commented default, add it somewhere in the beginning
+        ensure_option("PermitRootLogin", "yes", "PermitRootLogin", fallback=True),
+    ])
 
 '''
 Add Vz8 repositories
@@ -93,40 +472,40 @@ TODO:
 * check content of existing files if any - they should have exact repo id
 * check content of existing vz7 repo files - they also should have repo id expected by us
 '''
-def add_repos():
+def add_repos(opts):
     # When using --skip-vz, we use a dummy vz8 repo which actually points to the same
     # location as VzLinux8. The thing is that some packages (e.g., libvirt) are
     # assigned to "vz8" repo in pes-events and it is easier to manipulate repos
     # than pes-events.
-    if cmdline.use_vz9:
+    if opts.use_vz9:
         suf = '9'
     else:
         suf = '8'
 
-    if cmdline.skip_vz:
-        if os.path.isfile("/etc/yum.repos.d/vz" + suf + ".repo"):
-            os.remove("/etc/yum.repos.d/vz" + suf + ".repo")
+    if opts.skip_vz:
+        if os.path.isfile(os.path.join(YUM_REPOS_DIR, "vz" + suf + ".repo")):
+            os.remove(os.path.join(YUM_REPOS_DIR, "vz" + suf + ".repo"))
         for repo_file in ["vz" + suf + "_dummy.repo", "vzlinux" + suf + ".repo"]:
-            if not os.path.isfile("/etc/yum.repos.d/" + repo_file):
-                shutil.copyfile("/usr/share/vzupgrade/" + repo_file, "/etc/yum.repos.d/" + repo_file)
+            if not os.path.isfile(os.path.join(YUM_REPOS_DIR, repo_file)):
+                shutil.copyfile(os.path.join(VZUPGRADE_SHARE_DIR, repo_file), os.path.join(YUM_REPOS_DIR, repo_file))
     else:
-        if os.path.isfile("/etc/yum.repos.d/vz" + suf + "_dummy.repo"):
-            os.remove("/etc/yum.repos.d/vz" + suf + "_dummy.repo")
+        if os.path.isfile(os.path.join(YUM_REPOS_DIR, "vz" + suf + "_dummy.repo")):
+            os.remove(os.path.join(YUM_REPOS_DIR, "vz" + suf + "_dummy.repo"))
         for repo_file in ["vz" + suf + ".repo", "vzlinux" + suf + ".repo"]:
-            if not os.path.isfile("/etc/yum.repos.d/" + repo_file):
-                shutil.copyfile("/usr/share/vzupgrade/" + repo_file, "/etc/yum.repos.d/" + repo_file)
+            if not os.path.isfile(os.path.join(YUM_REPOS_DIR, repo_file)):
+                shutil.copyfile(os.path.join(VZUPGRADE_SHARE_DIR, repo_file), os.path.join(YUM_REPOS_DIR, repo_file))
 
 '''
 Put file with answers to required place.
 Currently we don't have any questions to ask user, so just use pre-created file
 '''
 def add_answers():
-    if not os.path.exists("/var/log/leapp"):
-        os.makedirs("/var/log/leapp")
+    if not os.path.exists(LEAPP_LOG_DIR):
+        os.makedirs(LEAPP_LOG_DIR)
     for f in ["answerfile", "answerfile.userchoices"]:
-        if os.path.isfile("/var/log/leapp/" + f):
-            os.remove("/var/log/leapp/" + f)
-        copyfile("/etc/leapp/answers/" + f, "/var/log/leapp/" + f)
+        if os.path.isfile(os.path.join(LEAPP_LOG_DIR, f)):
+            os.remove(os.path.join(LEAPP_LOG_DIR, f))
+        copyfile(os.path.join(LEAPP_ANSWERS_DIR, f), os.path.join(LEAPP_LOG_DIR, f))
 
 '''
 Some kernel modules are dropped in Vz8 but can be met on Vz7.
@@ -134,167 +513,1189 @@ This will inhibit the upgrade in leapp, but some modules can be safely unloaded
 '''
 def drop_problematic_mods():
     FNULL = open(os.devnull, 'w')
-    ret = subprocess.call(['modprobe', '-r', 'isci'], stdout=FNULL, stderr=FNULL)
+    ret = traced_call(['modprobe', '-r', 'isci'], stdout=FNULL, stderr=FNULL)
 
 
 '''
 Before running check or upgrade, we should put some files to proper places
 '''
-def prepare_files():
+@traced_phase
+def prepare_files(opts):
     fix_sshd_config()
-    add_repos()
+    add_repos(opts)
     add_answers()
     drop_problematic_mods()
 
 '''
-Run custom pre-check scripts
+Read executable hooks from the given folder.
+
+Hooks are ordered by numeric prefixes of their names: a hook with prefix
+('01-prepare') starts after all hooks with smaller prefixes have finished,
+hooks with the same prefix run in parallel. Hooks without prefix keep the
+old behavior and start after all hooks preceding them in alphabetical order.
+
+A hook can declare additional dependencies and its own timeout in its header:
+# vzupgrade-after: 01-prepare other-hook
+# vzupgrade-timeout: 60
+
+Declared dependencies take precedence: an ordering dependency which would
+form a cycle with them is dropped.
+
+Return dictionary {name: (path, dependencies, timeout)}
 '''
-def run_precheck_hooks():
-    if not os.path.isdir(PRECHECK_DIR):
-        return
-    for f in sorted(os.listdir(PRECHECK_DIR)):
-        if os.access(os.path.join(PRECHECK_DIR, f), os.X_OK):
-            subprocess.call(os.path.join(PRECHECK_DIR, f))
+def read_hooks(hook_dir):
+    if not os.path.isdir(hook_dir):
+        return {}
+
+    names = [f for f in sorted(os.listdir(hook_dir)) if os.access(os.path.join(hook_dir, f), os.X_OK)]
+    hooks = {}
+    for name in names:
+        path = os.path.join(hook_dir, name)
+        deps = set()
+        timeout = HOOK_TIMEOUT
+        try:
+            with open(path, errors='replace') as f:
+                for l in f.readlines(4096):
+                    h = re.match(r'#\s*vzupgrade-(after|timeout):\s*(.*)', l.strip())
+                    if h and h.group(1) == 'after':
+                        deps.update(d for d in h.group(2).split() if d in names and d != name)
+                    elif h and h.group(2).strip().isdigit():
+                        timeout = int(h.group(2).strip())
+        except (IOError, OSError):
+            pass
+        hooks[name] = (path, deps, timeout)
+
+    def reaches(start, target):
+        seen = set()
+        stack = [start]
+        while stack:
+            n = stack.pop()
+            if n == target:
+                return True
+            if n not in seen:
+                seen.add(n)
+                stack.extend(hooks[n][1])
+        return False
+
+    for (idx, name) in enumerate(names):
+        m = re.match(r'(\d+)', name)
+        if m:
+            order = [n for n in names if re.match(r'(\d+)', n) and int(re.match(r'(\d+)', n).group(1)) < int(m.group(1))]
+        else:
+            order = names[:idx]
+        deps = hooks[name][1]
+        deps.update(d for d in order if not reaches(d, name))
+    return hooks
+
+'''
+Run a single hook saving its output to a log file. The hook is started
+in its own session, so processes it spawns are killed with it on timeout.
+Return its status (exit code or 'timeout') and duration
+'''
+def run_hook(stage, path, timeout):
+    os.makedirs(HOOK_LOG_DIR, exist_ok=True)
+    start = time.time()
+    with open(os.path.join(HOOK_LOG_DIR, "%s-%s.log" % (stage, os.path.basename(path))), 'w') as out:
+        try:
+            status = traced_call(path, stdout=out, stderr=subprocess.STDOUT, timeout=timeout,
+                                 start_new_session=True)
+        except subprocess.TimeoutExpired:
+            status = 'timeout'
+        except OSError as e:
+            status = str(e)
+    return status, time.time() - start
 
+'''
+Run hooks from the given folder respecting their dependencies,
+at most HOOK_JOBS at once. Return the number of failed hooks
+'''
+def run_hooks(stage, hook_dir):
+    pending = read_hooks(hook_dir)
+    if not pending:
+        return 0
 
+    finished = {}
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HOOK_JOBS) as executor:
+        while pending or running:
+            ready = [n for n in sorted(pending) if pending[n][1].issubset(finished)]
+            if not ready and not running:
+                # Dependency loop, just run hooks in alphabetical order
+                ready = [sorted(pending)[0]]
+                print("Warning: %s hooks %s have cyclic dependencies, running %s first"
+                      % (stage, ", ".join(sorted(pending)), ready[0]))
+            for name in ready:
+                (path, deps, timeout) = pending.pop(name)
+                running[executor.submit(run_hook, stage, path, timeout)] = name
+
+            (done, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                finished[name] = f.result()
+
+    failed = 0
+    for name in sorted(finished):
+        (status, duration) = finished[name]
+        if status != 0:
+            failed += 1
+        print("%s hook %s: %s in %.1f seconds" % (stage, name, "ok" if status == 0 else "failed (%s)" % status, duration))
+    return failed
 
+'''
+Run custom pre-check scripts
+'''
+@traced_phase
+def run_precheck_hooks():
+    return run_hooks('pre-check', PRECHECK_DIR)
 
 '''
 Run custom pre-install scripts
 '''
+@traced_phase
 def run_preinstall_hooks():
-    if not os.path.isdir(PREINST_DIR):
-        return
-    for f in sorted(os.listdir(PREINST_DIR)):
-        if os.access(os.path.join(PREINST_DIR, f), os.X_OK):
-            subprocess.call(os.path.join(PREINST_DIR, f))
+    return run_hooks('pre-install', PREINST_DIR)
 
 
 '''
-Check upgrade prerequisites
+Put repository map and PES events for the target release in place.
+Return leapp command for the given action and its environment
 '''
-def check():
-    prepare_files()
+def prepare_leapp(opts, action):
+    suf = '9' if opts.use_vz9 else '8'
+
+    d = dict(os.environ)
+    if opts.skip_vz:
+        d['SKIPVZ'] = '1'
+
+    for f in ["repomap", "pes-events"]:
+        ext = ".csv" if f == "repomap" else ".json"
+        if os.path.exists(os.path.join(LEAPP_FILES_DIR, f + ext)):
+            os.unlink(os.path.join(LEAPP_FILES_DIR, f + ext))
+        src = os.path.join(LEAPP_FILES_DIR, f + "-vz" + suf + ext)
+        if f == "pes-events" and not opts.no_pes_filter:
+            try:
+                src = get_reduced_pes_events(opts, src)
+            except Exception as e:
+                print("Failed to filter PES events, using the full set: %s" % e)
+        os.link(src, os.path.join(LEAPP_FILES_DIR, f + ext))
+
+    leapp_cmd = ['leapp', action, '--no-rhsm', '--enablerepo=vz' + suf, '--enablerepo=vzlinux' + suf]
+    if opts.enablerepo:
+        for repo in opts.enablerepo:
+            leapp_cmd.append('--enablerepo=' + repo)
+
+    # Use packages downloaded in advance by 'vzupgrade prefetch'
+    for repoid in enable_prefetched_repos(opts):
+        leapp_cmd.append('--enablerepo=' + repoid)
+
+    if opts.debug:
+        leapp_cmd.append('--debug')
+    elif opts.verbose:
+        leapp_cmd.append('--verbose')
+
+    return leapp_cmd, d
+
+'''
+Fingerprint of rpmdb state. rpmdb files are rewritten
+on every transaction, so their sizes and mtimes are enough
+'''
+def rpmdb_fingerprint():
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(RPMDB_DIR, '*'))):
+        if os.path.basename(path).startswith('__db'):
+            continue
+        st = os.stat(path)
+        h.update(("%s %d %d\n" % (path, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+# Installed packages are read once per rpmdb state, even by concurrent checks
+rpmdb_lock = threading.Lock()
+rpmdb_cache = {}
+
+'''
+Read installed packages from rpmdb.
+Return list of (name, epoch, version, release, arch, size) tuples
+'''
+def read_rpmdb():
+    with rpmdb_lock:
+        fingerprint = rpmdb_fingerprint()
+        if fingerprint in rpmdb_cache:
+            return rpmdb_cache[fingerprint]
+
+        out = traced_check_output(['rpm', '-qa', '--qf', '%{NAME} %{EPOCHNUM} %{VERSION} %{RELEASE} %{ARCH} %{SIZE}\\n'])
+        packages = []
+        for l in out.decode('utf-8').split("\n"):
+            fields = l.split()
+            if len(fields) == 6:
+                packages.append((fields[0], int(fields[1]), fields[2], fields[3], fields[4], int(fields[5])))
+
+        rpmdb_cache.clear()
+        rpmdb_cache[fingerprint] = packages
+        return packages
+
+'''
+Names of packages in a PES event package set
+'''
+def pes_packages(pkgset):
+    return [p['name'] for p in ((pkgset or {}).get('package') or [])]
+
+'''
+Reduce PES events to the ones which can apply to the installed packages.
+
+Events are indexed by names of their input packages. Starting from the installed
+packages, we follow events transitively: packages produced by an applicable event
+can be input of later events. Events without input packages are always kept.
+Return numbers of all and kept events
+'''
+def reduce_pes_events(src, dst, installed):
+    with open(src) as f:
+        data = json.load(f)
+    events = data['packageinfo']
+
+    by_name = {}
+    keep = set()
+    for (i, e) in enumerate(events):
+        names = pes_packages(e.get('in_packageset'))
+        if not names:
+            keep.add(i)
+        for name in names:
+            by_name.setdefault(name, []).append(i)
+
+    queue = list(set(installed))
+    seen = set(queue)
+    while queue:
+        for i in by_name.get(queue.pop(), []):
+            if i in keep:
+                continue
+            keep.add(i)
+            for name in pes_packages(events[i].get('out_packageset')):
+                if name not in seen:
+                    seen.add(name)
+                    queue.append(name)
+
+    data['packageinfo'] = [e for (i, e) in enumerate(events) if i in keep]
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(dst))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, dst)
+    return len(events), len(keep)
+
+'''
+Get PES events file reduced to the installed packages.
+The reduced file is rebuilt only if rpmdb or the original file have changed
+'''
+def get_reduced_pes_events(opts, src):
+    dst = src[:-len('.json')] + '-reduced.json'
+    keyfile = os.path.join(VZUPGRADE_DIR, os.path.basename(dst) + '.key')
+    st = os.stat(src)
+    key = "%s %d %d" % (rpmdb_fingerprint(), st.st_size, st.st_mtime_ns)
+
+    try:
+        with open(keyfile) as f:
+            if f.read().strip() == key and os.path.isfile(dst):
+                return dst
+    except (IOError, OSError):
+        pass
+
+    start = time.time()
+    (total, kept) = reduce_pes_events(src, dst, [p[0] for p in read_rpmdb()])
+    if opts.verbose or opts.debug:
+        print("PES events reduced from %d to %d in %.2f seconds" % (total, kept, time.time() - start))
+
+    os.makedirs(VZUPGRADE_DIR, exist_ok=True)
+    with open(keyfile, 'w') as f:
+        f.write(key + "\n")
+    return dst
+
+'''
+Format duration in seconds as a short human-readable string
+'''
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+'''
+Atomically write current leapp progress to the status file
+'''
+def write_status(status):
+    try:
+        os.makedirs(os.path.dirname(STATUS_FILE), exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(STATUS_FILE))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, STATUS_FILE)
+    except (IOError, OSError):
+        pass
+
+'''
+Run leapp streaming its output line by line.
+
+Transitions between leapp phases and actors are tracked: on every phase change
+a progress line with elapsed time and estimated remaining time is printed.
+The estimate is based on phase durations of the previous run of the same
+leapp command on this node. Current progress is also saved to STATUS_FILE.
+
+Return leapp exit code
+'''
+def run_leapp(leapp_cmd, env):
+    action = leapp_cmd[1]
+    try:
+        with open(LEAPP_TIMINGS) as f:
+            history = json.load(f)
+    except (IOError, OSError, ValueError):
+        history = {}
+    previous = history.get(action, [])
+    expected = dict(previous)
+
+    env = dict(env)
+    env['PYTHONUNBUFFERED'] = '1'
+    start = time.time()
+    phases = []
+    status = {'action': action, 'state': 'running', 'pid': os.getpid(), 'start': start,
+              'phase': None, 'actor': None, 'phase_index': 0, 'phases_expected': len(previous),
+              'elapsed': 0, 'eta': None}
+
+    def phase_finished():
+        if phases:
+            phases[-1][1] = round(time.time() - phases[-1][1], 3)
+            trace_event('leapp-phase', phases[-1][0], time.time() - phases[-1][1], 0)
+
+    def update(phase=None, actor=None):
+        now = time.time()
+        status['elapsed'] = round(now - start, 1)
+        if phase:
+            phase_finished()
+            phases.append([phase, now])
+            status['phase'] = phase
+            status['actor'] = None
+            status['phase_index'] = len(phases)
+            names = [p[0] for p in previous]
+            if phase in names:
+                status['eta'] = round(sum(d for (n, d) in previous[names.index(phase):]), 1)
+            else:
+                status['eta'] = None
+            eta = (" ETA %s" % format_duration(status['eta'])) if status['eta'] is not None else ""
+            print("[vzupgrade] %s: phase %d/%s %s, elapsed %s%s"
+                  % (action, len(phases), len(previous) or '?', phase, format_duration(now - start), eta))
+            sys.stdout.flush()
+        if actor:
+            status['actor'] = actor
+        write_status(status)
+
+    proc = TracedPopen(leapp_cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        for line in iter(proc.stdout.readline, b''):
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+            text = line.decode('utf-8', 'replace').rstrip()
+            m = re.match(r'==> Processing phase `(.+)`', text)
+            if m:
+                update(phase=m.group(1))
+                continue
+            m = re.match(r'====> \* (\S+)', text)
+            if m:
+                update(actor=m.group(1))
+        proc.wait()
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        trace_command(leapp_cmd, start, proc.returncode, proc)
+
+    phase_finished()
+    status.update({'state': 'finished', 'exit_code': proc.returncode, 'elapsed': round(time.time() - start, 1), 'eta': 0})
+    write_status(status)
+
+    # A failed run stops early, its phases would spoil ETA of the next runs
+    if proc.returncode:
+        return proc.returncode
+
+    history[action] = phases
+    try:
+        os.makedirs(VZUPGRADE_DIR, exist_ok=True)
+        with open(LEAPP_TIMINGS, 'w') as f:
+            json.dump(history, f)
+    except (IOError, OSError):
+        pass
+
+    return proc.returncode
+
+'''
+Compute fingerprint of everything that affects 'leapp preupgrade' result:
+rpmdb state, yum repositories, leapp data and answer files, command line
+options and vzupgrade itself
+'''
+def check_fingerprint(opts):
+    suf = '9' if opts.use_vz9 else '8'
+    h = hashlib.sha256()
+    h.update(rpmdb_fingerprint().encode('utf-8'))
+
+    for path in sorted(glob.glob(os.path.join(YUM_REPOS_DIR, '*.repo'))) + [
+            os.path.join(LEAPP_FILES_DIR, 'repomap-vz' + suf + '.csv'),
+            os.path.join(LEAPP_FILES_DIR, 'pes-events-vz' + suf + '.json'),
+            os.path.join(LEAPP_ANSWERS_DIR, 'answerfile'),
+            os.path.join(LEAPP_ANSWERS_DIR, 'answerfile.userchoices'),
+            os.path.abspath(__file__)]:
+        h.update((path + "\n").encode('utf-8'))
+        try:
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        except (IOError, OSError):
+            pass
+
+    h.update(json.dumps([sorted(opts.enablerepo or []), opts.skip_vz, opts.use_vz9]).encode('utf-8'))
+    return h.hexdigest()
+
+'''
+Reuse leapp reports of the last successful check if nothing has changed since then.
+Return True if the reports were reused
+'''
+def load_check_cache(fingerprint):
+    try:
+        with open(os.path.join(CHECK_CACHE_DIR, 'fingerprint')) as f:
+            if f.read().strip() != fingerprint:
+                return False
+        # Bring back reports removed since the check
+        for r in LEAPP_REPORTS:
+            if os.path.isfile(os.path.join(CHECK_CACHE_DIR, r)) and not os.path.isfile(os.path.join(LEAPP_LOG_DIR, r)):
+                shutil.copyfile(os.path.join(CHECK_CACHE_DIR, r), os.path.join(LEAPP_LOG_DIR, r))
+        mtime = os.path.getmtime(os.path.join(CHECK_CACHE_DIR, 'fingerprint'))
+    except (IOError, OSError):
+        return False
+
+    print("Nothing has changed since the successful check at %s, leapp preupgrade is skipped."
+          % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime)))
+    print("The report is available at %s. Use '--force' to run the full check."
+          % os.path.join(LEAPP_LOG_DIR, LEAPP_REPORTS[0]))
+    return True
+
+'''
+Remember fingerprint and leapp reports of a successful check
+'''
+def save_check_cache(fingerprint):
+    os.makedirs(CHECK_CACHE_DIR, exist_ok=True)
+    for r in LEAPP_REPORTS:
+        if os.path.isfile(os.path.join(LEAPP_LOG_DIR, r)):
+            shutil.copyfile(os.path.join(LEAPP_LOG_DIR, r), os.path.join(CHECK_CACHE_DIR, r))
+    with open(os.path.join(CHECK_CACHE_DIR, 'fingerprint'), 'w') as f:
+        f.write(fingerprint + "\n")
+
+'''
+Check upgrade prerequisites, printing the progress like 'vzupgrade check'.
+
+Return the blocker report (see list_blockers()) extended with 'exit_code'
+of the check and 'leapp' - None if leapp was not launched or a dictionary
+with its 'exit_code' and 'cached' flag set if the result of the previous
+check was reused
+'''
+def run_check(opts=None):
+    if opts is None:
+        opts = make_options('check')
+
+    prepare_files(opts)
     run_precheck_hooks()
-    if check_blockers():
-        return 1
+    result = list_blockers(opts)
+    result.update({'exit_code': 1, 'leapp': None})
+    if print_blockers(opts, result):
+        return result
 
     # Should we only check blockers?
-    if cmdline.blocker:
-        return 0
+    if opts.blocker:
+        result['exit_code'] = 0
+        return result
 
     try:
-        d = dict(os.environ)
-        if cmdline.skip_vz:
-            d['SKIPVZ'] = '1'
-        if os.path.exists("/etc/leapp/files/repomap.csv"):
-            os.unlink("/etc/leapp/files/repomap.csv")
-        if os.path.exists("/etc/leapp/files/pes-events.json"):
-            os.unlink("/etc/leapp/files/pes-events.json")
-
-        if cmdline.use_vz9:
-            os.link("/etc/leapp/files/repomap-vz9.csv", "/etc/leapp/files/repomap.csv")
-            os.link("/etc/leapp/files/pes-events-vz9.json", "/etc/leapp/files/pes-events.json")
-            leapp_cmd = ['leapp', 'preupgrade', '--no-rhsm', '--enablerepo=vz9', '--enablerepo=vzlinux9']
-        else:
-            os.link("/etc/leapp/files/repomap-vz8.csv", "/etc/leapp/files/repomap.csv")
-            os.link("/etc/leapp/files/pes-events-vz8.json", "/etc/leapp/files/pes-events.json")
-            leapp_cmd = ['leapp', 'preupgrade', '--no-rhsm', '--enablerepo=vz8', '--enablerepo=vzlinux8']
-        if cmdline.enablerepo:
-            for repo in cmdline.enablerepo:
-                leapp_cmd.append('--enablerepo=' + repo)
-
-        if cmdline.debug:
-            leapp_cmd.append('--debug')
-        elif cmdline.verbose:
-            leapp_cmd.append('--verbose')
-
-        subprocess.check_call(leapp_cmd, env=d)
+        (leapp_cmd, d) = prepare_leapp(opts, 'preupgrade')
+
+        fingerprint = check_fingerprint(opts)
+        if not opts.force and load_check_cache(fingerprint):
+            # Keep the full snapshot of the cached check, install archives the changes made since then
+            if not glob.glob(os.path.join(VZUPGRADE_DIR, 'etc.tar.*')):
+                snapshot_etc()
+            result.update({'exit_code': 0, 'leapp': {'exit_code': 0, 'cached': True}})
+            return result
+
+        # Full snapshot of /etc, install will only archive the changes
+        snapshot_etc()
+
+        ret = run_leapp(leapp_cmd, d)
+        result['leapp'] = {'exit_code': ret, 'cached': False}
+        if ret:
+            return result
+        save_check_cache(fingerprint)
+        result['exit_code'] = 0
     except:
-        return 1
+        pass
+    return result
+
+'''
+Check upgrade prerequisites
+'''
+@traced_phase
+@json_stdout
+def check(opts):
+    return run_check(opts)['exit_code']
 
 
 '''
-Check if templates are used that are not supported in Vz8
+Get OS template of a container from its config. Configs are shell-style,
+so the last OSTEMPLATE assignment wins.
+Return None if the config can't be read or doesn't contain OSTEMPLATE
 '''
-def check_templates():
-    invalid_templates = {}
-    valid_templates=[
-    "almalinux-8-x86_64",
-    "centos-7-x86_64",
-    "centos-8-x86_64",
-    "centos-8.stream-x86_64",
-    "centos-9.stream-x86_64",
-    "debian-11.0-x86_64",
-    "debian-10.0-x86_64",
-    "debian-9.0-x86_64",
-    "ubuntu-18.04-x86_64",
-    "ubuntu-18.10-x86_64",
-    "ubuntu-19.04-x86_64",
-    "ubuntu-19.10-x86_64",
-    "ubuntu-20.04-x86_64",
-    "ubuntu-20.10-x86_64",
-    "ubuntu-21.04-x86_64",
-    "ubuntu-21.10-x86_64",
-    "sles-11-x86_64",
-    "sles-12-x86_64",
-    "sles-15-x86_64",
-    "vzlinux-7-x86_64",
-    "vzlinux-8-x86_64",
-    "vzlinux-8.stream-x86_64"
-    "vzlinux-9-x86_64",
-    "vzlinux-9.stream-x86_64"
-    ]
-
-    ctids = subprocess.check_output(["vzlist", "-o", "ctid", "-a", "-H"])
-    if not ctids:
-        return 0
+def read_ct_ostemplate(ct):
+    tmpl = None
+    try:
+        with open(os.path.join(VZ_CONF_DIR, ct + ".conf")) as f:
+            for l in f:
+                l = l.strip()
+                if l.startswith("OSTEMPLATE="):
+                    # EZ templates can be stored with leading dot
+                    tmpl = l.split("=", 1)[1].strip('"\'').lstrip('.') or None
+    except (IOError, OSError):
+        return None
+    return tmpl
+
+'''
+Get OS template of a container by means of vzpkg
+'''
+def vzpkg_ostemplate(ct):
+    tmpl = traced_check_output(["vzpkg", "list", ct, "-q", "--os"]).decode('utf-8').split()
+    if not tmpl:
+        return "unknown"
+    return tmpl[0]
+
+'''
+Collect OS templates of all containers in one pass.
+
+Templates are read from container configs directly, vzpkg is launched
+only for containers whose configs don't provide OSTEMPLATE, using
+at most TEMPLATE_JOBS parallel processes. The result is saved
+to TEMPLATES_INVENTORY.
+
+Return dictionary {template: [ctid, ...]}
+'''
+@traced_phase
+def get_templates_inventory(opts):
+    start = time.time()
+    ctids = traced_check_output(["vzlist", "-o", "ctid", "-a", "-H"])
+    cts = [ct.strip() for ct in ctids.decode('utf-8').split("\n") if ct.strip()]
+
+    templates = {}
+    missing = []
+    for ct in cts:
+        tmpl = read_ct_ostemplate(ct)
+        if tmpl:
+            templates.setdefault(tmpl, []).append(ct)
+        else:
+            missing.append(ct)
+
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=TEMPLATE_JOBS) as executor:
+            # Workers inherit the deadline of the check, if any
+            deadline = getattr(task_deadline, 'value', None)
+
+            def worker(ct):
+                task_deadline.value = deadline
+                return vzpkg_ostemplate(ct)
+
+            for ct, tmpl in zip(missing, executor.map(worker, missing)):
+                templates.setdefault(tmpl, []).append(ct)
+
+    if opts.verbose or opts.debug:
+        print("Collected OS templates of %d containers (%d via vzpkg) in %.2f seconds"
+              % (len(cts), len(missing), time.time() - start))
+        for tmpl in sorted(templates):
+            print("  %s: %s" % (tmpl, " ".join(templates[tmpl])))
+
+    try:
+        os.makedirs(VZUPGRADE_DIR, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=VZUPGRADE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(templates, f, indent=4, sort_keys=True)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, TEMPLATES_INVENTORY)
+    except (IOError, OSError) as e:
+        print("Failed to save %s: %s" % (TEMPLATES_INVENTORY, e))
+
+    return templates
+
+'''
+Compile template policy file into a set of exact template names and
+an index of rules by distribution name (the part before the first '-').
+
+Policy file contains 'exact' names of supported templates and 'rules' with
+glob 'pattern' and optional 'min_version' and 'max_version'. The part of a
+template name matched by the first '*' is its version, it is compared with
+the bounds the way rpm compares versions. Rules whose distribution name
+has a wildcard (e.g. '*-x86_64') are indexed under None and checked for
+every template.
+The result is cached until the file changes
+'''
+@functools.lru_cache(maxsize=None)
+def compile_template_policy(path, mtime):
+    with open(path) as f:
+        policy = json.load(f)
+    if policy.get('format') != TEMPLATE_POLICY_FORMAT:
+        raise ValueError("Unsupported format of %s: %s" % (path, policy.get('format')))
+
+    index = {}
+    for rule in policy.get('rules', []):
+        regex = re.compile("(.+)".join(re.escape(p) for p in rule['pattern'].split('*')) + "$")
+        key = rule['pattern'].split('-', 1)[0]
+        index.setdefault(None if '*' in key else key, []).append(
+            (regex, rule.get('min_version'), rule.get('max_version')))
+    return frozenset(policy.get('exact', [])), index
+
+'''
+Load policy of templates supported by the target release
+'''
+def load_template_policy(opts):
+    path = TEMPLATE_POLICY % ('9' if opts.use_vz9 else '8')
+    return compile_template_policy(path, os.stat(path).st_mtime)
 
-    for ct in ctids.decode('utf-8').split("\n"):
-        ct = ct.strip()
-        if not ct:
+'''
+Check if a template is allowed by the compiled policy
+'''
+def template_supported(policy, tmpl):
+    (exact, index) = policy
+    if tmpl in exact:
+        return True
+    for (regex, min_version, max_version) in index.get(tmpl.split('-', 1)[0], []) + index.get(None, []):
+        m = regex.match(tmpl)
+        if not m:
             continue
-        tmpl = subprocess.check_output(["vzpkg", "list", ct, "-q", "--os"])
-        tmpl = tmpl.decode('utf-8').split()[0]
-        if tmpl not in valid_templates:
-            if tmpl in invalid_templates:
-                invalid_templates[tmpl].append(ct)
-            else:
-                invalid_templates[tmpl] = [ct]
+        version = m.group(1) if m.groups() else None
+        if min_version and (version is None or rpmvercmp(version, min_version) < 0):
+            continue
+        if max_version and (version is None or rpmvercmp(version, max_version) > 0):
+            continue
+        return True
+    return False
+
+'''
+Check if templates are used that are not supported in the target release
+'''
+@register_blocker('templates', timeout=600, vz_only=True)
+def check_templates(opts):
+    policy = load_template_policy(opts)
+    invalid_templates = {}
+    for tmpl, cts in get_templates_inventory(opts).items():
+        if not template_supported(policy, tmpl):
+            invalid_templates[tmpl] = cts
 
     if invalid_templates:
-        print("Containers found that use templates not supported by VHS 8")
-        print(invalid_templates)
-        return 1
+        return ["Containers found that use templates not supported by VHS %d" % (9 if opts.use_vz9 else 8),
+                str(invalid_templates)]
 
+    return []
+
+'''
+Report OS templates of containers: number of containers using
+every template and whether it is supported by the target release
+'''
+@json_stdout
+def report_templates(opts):
+    policy = load_template_policy(opts)
+    templates = get_templates_inventory(opts)
+    report = [{'template': tmpl, 'containers': len(cts), 'supported': template_supported(policy, tmpl)}
+              for (tmpl, cts) in sorted(templates.items(), key=lambda x: (-len(x[1]), x[0]))]
+
+    if opts.format == 'json':
+        print(json.dumps(report, indent=4), file=getattr(opts, 'json_stream', sys.stdout))
+        return 0
+
+    print("%-40s %6s  %s" % ("TEMPLATE", "CTS", "VHS %d" % (9 if opts.use_vz9 else 8)))
+    for r in report:
+        print("%-40s %6d  %s" % (r['template'], r['containers'], "supported" if r['supported'] else "NOT SUPPORTED"))
+    print("%d containers, %d templates, %d containers use unsupported templates"
+          % (sum(r['containers'] for r in report), len(report),
+             sum(r['containers'] for r in report if not r['supported'])))
     return 0
 
 
 '''
-Explicitely launch VZ-specific preupgrade-assistant checkers
-that check for upgrade blockers
+Normalize driver name - modules can use both '-' and '_' in their names
 '''
-def check_blockers():
-    FNULL = open(os.devnull, 'w')
+def driver_key(name):
+    return name.replace('-', '_')
+
+'''
+Load device driver deprecation data as a pair of dictionaries:
+{device_id: (name, available_in, maintained_in)} for PCI devices and
+{driver: (name, available_in, maintained_in)} for drivers.
+
+Device ids are in lower case: 'vendor:device[:subvendor[:subdevice]]'.
+The index is cached in DEVICE_DATA_CACHE and rebuilt when the data file changes
+'''
+def load_device_index():
+    import pickle
+    mtime = os.stat(DEVICE_DATA_FILE).st_mtime
+    try:
+        with open(DEVICE_DATA_CACHE, 'rb') as f:
+            (cached_mtime, index) = pickle.load(f)
+        if cached_mtime == mtime:
+            return index
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    with open(DEVICE_DATA_FILE) as f:
+        data = json.load(f)['data']
+
+    devices = {}
+    drivers = {}
+    for e in data:
+        if e['device_type'] != 'pci':
+            continue
+        info = (e['device_name'] or e['driver_name'], tuple(e['available_in_rhel']), tuple(e['maintained_in_rhel']))
+        if e['device_id']:
+            devices[e['device_id'].lower()] = info
+        else:
+            drivers[driver_key(e['driver_name'])] = info
+    index = (devices, drivers)
+
+    try:
+        os.makedirs(VZUPGRADE_DIR, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=VZUPGRADE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((mtime, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, DEVICE_DATA_CACHE)
+    except (IOError, OSError):
+        # Cache is only an optimization
+        pass
 
-    ret = subprocess.call(['yum', 'check-update'], stdout=FNULL, stderr=FNULL)
-    if ret > 0:
-        print("INPLACERISK: EXTREME: You have updates available! Please install all updates first")
+    return index
 
-    if not cmdline.skip_vz:
-        ret += check_templates()
+'''
+Read a sysfs attribute of a PCI device
+'''
+def read_pci_attr(dev, attr):
+    try:
+        with open(os.path.join(SYSFS_PCI_DIR, dev, attr)) as f:
+            return f.read().strip().lower()
+    except (IOError, OSError):
+        return None
+
+'''
+Find present devices and drivers which are deprecated or removed in the target release.
+Return dictionary {'removed': [...], 'deprecated': [...]} with descriptions of found items.
+The result is computed only once per run of blocker checks
+'''
+@functools.lru_cache(maxsize=None)
+def scan_hardware(target):
+    (devices, drivers) = load_device_index()
+    found = {'removed': [], 'deprecated': []}
+
+    def report(what, info):
+        (name, available, maintained) = info
+        if target not in available:
+            found['removed'].append("%s (%s)" % (name, what))
+        elif target not in maintained:
+            found['deprecated'].append("%s (%s)" % (name, what))
+
+    used_drivers = set()
+    if os.path.isdir(SYSFS_PCI_DIR):
+        for dev in sorted(os.listdir(SYSFS_PCI_DIR)):
+            ids = [read_pci_attr(dev, a) for a in ['vendor', 'device', 'subsystem_vendor', 'subsystem_device']]
+            for n in [4, 3, 2]:
+                if None in ids[:n]:
+                    continue
+                devid = ":".join(ids[:n])
+                if devid in devices:
+                    report("PCI device %s, %s" % (dev, devid), devices[devid])
+                    break
+            driver = os.path.join(SYSFS_PCI_DIR, dev, 'driver')
+            if os.path.islink(driver):
+                used_drivers.add(driver_key(os.path.basename(os.readlink(driver))))
+
+    try:
+        with open(PROC_MODULES) as f:
+            for l in f:
+                used_drivers.add(driver_key(l.split()[0]))
+    except (IOError, OSError):
+        pass
+
+    for driver in sorted(used_drivers):
+        if driver in drivers:
+            report("driver %s" % driver, drivers[driver])
+
+    return found
+
+'''
+Check for hardware which is not supported by the target release
+'''
+@register_blocker('hardware_removed')
+def check_removed_hardware(opts):
+    found = scan_hardware(9 if opts.use_vz9 else 8)['removed']
+    if found:
+        return ["Hardware or drivers not supported by VHS %d are used:" % (9 if opts.use_vz9 else 8)] + \
+               ["  " + f for f in found]
+    return []
+
+'''
+Check for hardware which is deprecated in the target release
+'''
+@register_blocker('hardware_deprecated', severity='warning')
+def check_deprecated_hardware(opts):
+    found = scan_hardware(9 if opts.use_vz9 else 8)['deprecated']
+    if found:
+        return ["Hardware or drivers deprecated in VHS %d are used:" % (9 if opts.use_vz9 else 8)] + \
+               ["  " + f for f in found]
+    return []
+
+'''
+Compare two rpm version strings the way rpm does.
+Return 1 if 'a' is newer, -1 if 'b' is newer and 0 if they are equal
+'''
+def rpmvercmp(a, b):
+    if a == b:
+        return 0
+    sa = re.findall(r'~|[0-9]+|[a-zA-Z]+', a)
+    sb = re.findall(r'~|[0-9]+|[a-zA-Z]+', b)
+    for (x, y) in zip(sa, sb):
+        if x == '~' or y == '~':
+            if x != y:
+                return -1 if x == '~' else 1
+            continue
+        if x.isdigit() != y.isdigit():
+            # numeric segments are always newer than alpha ones
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            (x, y) = (int(x), int(y))
+        if x != y:
+            return 1 if x > y else -1
+    if len(sa) == len(sb):
+        return 0
+    # 'a~rc1' is older than 'a' while 'a.1' is newer
+    longer = sa if len(sa) > len(sb) else sb
+    newer = longer[min(len(sa), len(sb))] != '~'
+    return (1 if newer else -1) * (1 if longer is sa else -1)
+
+XMLNS_COMMON = 'http://linux.duke.edu/metadata/common'
+XMLNS_RPM = 'http://linux.duke.edu/metadata/rpm'
+XMLNS_REPO = 'http://linux.duke.edu/metadata/repo'
+
+'''
+Compare (epoch, version, release) tuples
+'''
+def compare_evr(a, b):
+    if int(a[0] or 0) != int(b[0] or 0):
+        return 1 if int(a[0] or 0) > int(b[0] or 0) else -1
+    return rpmvercmp(a[1], b[1]) or rpmvercmp(a[2], b[2])
+
+'''
+Read yum repository configs.
+Return dictionary {repoid: {option: value}}
+'''
+def read_repo_configs():
+    import configparser
+    repos = {}
+    for path in sorted(glob.glob(os.path.join(YUM_REPOS_DIR, '*.repo'))):
+        conf = configparser.ConfigParser(interpolation=None, strict=False)
+        try:
+            conf.read(path)
+        except configparser.Error:
+            continue
+        for repoid in conf.sections():
+            repos[repoid] = dict(conf.items(repoid))
+    return repos
 
-    ret += check_space()
-    ret += check_va()
-    ret += check_storage_ui()
+'''
+Read options of a section of a yum config file, empty dictionary if it can't be read
+'''
+def read_yum_section(path, section):
+    import configparser
+    conf = configparser.ConfigParser(interpolation=None, strict=False)
+    try:
+        conf.read(path)
+    except configparser.Error:
+        return {}
+    return dict(conf.items(section)) if conf.has_section(section) else {}
+
+'''
+Check if a boolean yum option is set
+'''
+def yum_bool(value):
+    return value.strip() in ['1', 'yes', 'true', 'True']
+
+'''
+Split yum list option (exclude, includepkgs) into glob patterns
+'''
+def yum_list(value):
+    return value.replace(',', ' ').split()
+
+'''
+Check if a package matches any of yum package globs (by name or name.arch)
+'''
+def package_matches(p, patterns):
+    return any(fnmatch.fnmatchcase(p.name, pat) or fnmatch.fnmatchcase("%s.%s" % (p.name, p.arch), pat)
+               for pat in patterns)
+
+'''
+Find cached primary metadata of a repository, either yum sqlite
+database, dnf xml or upstream xml downloaded by 'vzupgrade prefetch'
+(target repositories are disabled on the host, so yum never caches them).
+Return None if the repository is not cached
+'''
+def find_repo_metadata(repoid):
+    found = glob.glob(os.path.join(YUM_CACHE_DIR, '*', '*', glob.escape(repoid), 'gen', 'primary_db.sqlite'))
+    found += glob.glob(os.path.join(PREFETCH_DIR, glob.escape(repoid), 'upstream', '*primary.xml.gz'))
+    for d in glob.glob(os.path.join(DNF_CACHE_DIR, glob.escape(repoid) + '-*')):
+        if re.match(re.escape(repoid) + '-[0-9a-f]{16}$', os.path.basename(d)):
+            found += glob.glob(os.path.join(d, 'repodata', '*primary.xml.gz'))
+    if not found:
+        return None
+    return max(found, key=os.path.getmtime)
+
+'''
+Read packages from primary repository metadata (sqlite or xml.gz)
+'''
+def read_repo_metadata(path):
+    import sqlite3
+    import gzip
+    import xml.etree.ElementTree as ET
+    if path.endswith('.sqlite'):
+        db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+        try:
+            return [RepoPackage(*row) for row in db.execute(
+                "SELECT name, arch, epoch, version, release, size_package, size_installed, "
+                "location_href, checksum_type, pkgId FROM packages")]
+        finally:
+            db.close()
+
+    ns = '{%s}' % XMLNS_COMMON
+    packages = []
+    with gzip.open(path) as f:
+        for (_, elem) in ET.iterparse(f):
+            if elem.tag != ns + 'package':
+                continue
+            ver = elem.find(ns + 'version')
+            size = elem.find(ns + 'size')
+            checksum = elem.find(ns + 'checksum')
+            packages.append(RepoPackage(elem.findtext(ns + 'name'), elem.findtext(ns + 'arch'),
+                                        ver.get('epoch'), ver.get('ver'), ver.get('rel'),
+                                        int(size.get('package')), int(size.get('installed')),
+                                        elem.find(ns + 'location').get('href'),
+                                        checksum.get('type'), checksum.text))
+            elem.clear()
+    return packages
+
+'''
+Index packages of cached repositories by (name, arch) keeping the newest ones.
+
+If repository configs are given, packages are filtered the way yum does:
+'exclude' and 'includepkgs' of repositories and the global 'exclude' are
+applied, and with yum-plugin-priorities enabled, packages are taken only
+from the repositories with the best priority among the ones providing
+a package with the same name.
+
+Return the index and the list of repositories without cached metadata
+'''
+def index_repo_packages(repoids, repos=None):
+    priorities = False
+    exclude = []
+    if repos is not None:
+        main = read_yum_section(YUM_CONF, 'main')
+        exclude = yum_list(main.get('exclude', ''))
+        priorities = yum_bool(main.get('plugins', '0')) and \
+            yum_bool(read_yum_section(YUM_PRIORITIES_CONF, 'main').get('enabled', '0'))
+
+    candidates = []
+    best_priority = {}
+    uncached = []
+    for repoid in repoids:
+        path = find_repo_metadata(repoid)
+        if not path:
+            uncached.append(repoid)
+            continue
+        conf = (repos or {}).get(repoid, {})
+        repo_exclude = exclude + yum_list(conf.get('exclude', ''))
+        include = yum_list(conf.get('includepkgs', ''))
+        priority = int(conf.get('priority', YUM_DEFAULT_PRIORITY)) if priorities else YUM_DEFAULT_PRIORITY
+        for p in read_repo_metadata(path):
+            if repo_exclude and package_matches(p, repo_exclude):
+                continue
+            if include and not package_matches(p, include):
+                continue
+            candidates.append((priority, p))
+            best_priority[p.name] = min(priority, best_priority.get(p.name, priority))
+
+    newest = {}
+    for (priority, p) in candidates:
+        if priority != best_priority[p.name]:
+            continue
+        key = (p.name, p.arch)
+        if key not in newest or compare_evr((p.epoch, p.version, p.release),
+                                            (newest[key].epoch, newest[key].version, newest[key].release)) > 0:
+            newest[key] = p
+    return newest, uncached
+
+'''
+Find installed packages which have newer versions in cached metadata
+of enabled repositories. Metadata is never refreshed here.
+
+Only the newest installed version of a package is compared, so older
+instances of install-only packages (kernels) are not reported. Repository
+filters (exclude, includepkgs, priorities) are honoured, but unlike
+'yum check-update', obsoletes and versionlock are not taken into account.
+
+Return list of (name, installed evr, available evr) and the list of
+enabled repositories without cached metadata
+'''
+def find_updates():
+    configs = read_repo_configs()
+    repos = [r for (r, conf) in configs.items() if yum_bool(conf.get('enabled', '1'))]
+    (newest, uncached) = index_repo_packages(repos, configs)
+
+    installed = {}
+    for (name, epoch, version, release, arch, size) in read_rpmdb():
+        old = installed.get((name, arch))
+        if not old or compare_evr((epoch, version, release), old) > 0:
+            installed[(name, arch)] = (epoch, version, release)
+
+    updates = []
+    for ((name, arch), (epoch, version, release)) in installed.items():
+        p = newest.get((name, arch))
+        if p and compare_evr((p.epoch, p.version, p.release), (epoch, version, release)) > 0:
+            updates.append((name, "%s-%s" % (version, release), "%s-%s" % (p.version, p.release)))
+    return sorted(updates), uncached
 
-    if ret == 0:
+'''
+Check that all updates are installed.
+Cached repository metadata is used, it is refreshed only with --refresh
+'''
+@register_blocker('updates', timeout=YUM_TIMEOUT)
+def check_updates(opts):
+    if opts.refresh:
+        FNULL = open(os.devnull, 'w')
+        traced_call(['yum', 'makecache'], stdout=FNULL, stderr=FNULL, timeout=YUM_TIMEOUT)
+
+    (updates, uncached) = find_updates()
+    messages = []
+    if uncached:
+        messages.append("INPLACERISK: EXTREME: No cached metadata for repositories: %s. "
+                        "Please run 'vzupgrade check --refresh'" % ", ".join(uncached))
+    if updates:
+        messages.append("INPLACERISK: EXTREME: You have updates available! Please install all updates first")
+        messages += ["  %s: %s -> %s" % u for u in updates]
+
+    return messages
+
+'''
+Run a single blocker check, return its status, messages and latency
+'''
+def run_blocker(opts, blocker):
+    start = time.time()
+    task_deadline.value = start + blocker.timeout
+    try:
+        messages = blocker.func(opts)
+        status = 'fail' if messages else 'ok'
+    except Exception as e:
+        if isinstance(e, subprocess.TimeoutExpired) and time.time() >= task_deadline.value:
+            messages = ["Check of %s has not finished in %d seconds" % (blocker.name, blocker.timeout)]
+            status = 'timeout'
+        else:
+            messages = ["Failed to check %s: %s" % (blocker.name, e)]
+            status = 'error'
+    finally:
+        task_deadline.value = None
+    trace_event('blocker', blocker.name, start, status)
+    return status, messages, time.time() - start
+
+'''
+Run all registered blocker checks (or the ones with given names) concurrently.
+Checks run in daemon threads and commands launched by them are killed when
+the check timeout expires, so a hung check never delays exit.
+Return the list of results in the order of registration
+'''
+def run_blockers(opts, names=None):
+    blockers = [b for b in BLOCKERS if not (b.vz_only and opts.skip_vz) and (names is None or b.name in names)]
+    results = []
+    if not blockers:
+        return results
+    # Hardware could change since the previous run in a long-lived process
+    scan_hardware.cache_clear()
+
+    done = {}
+
+    def worker(b):
+        done[b.name] = run_blocker(opts, b)
+
+    threads = [threading.Thread(target=worker, args=(b,), daemon=True) for b in blockers]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for b, t in zip(blockers, threads):
+        t.join(max(0, start + b.timeout - time.time()))
+        if t.is_alive():
+            # Commands of the check are being killed right now
+            t.join(1)
+        if b.name in done:
+            (status, messages, latency) = done[b.name]
+        else:
+            status = 'timeout'
+            messages = ["Check of %s has not finished in %d seconds" % (b.name, b.timeout)]
+            latency = time.time() - start
+        results.append({
+            'name': b.name,
+            'severity': b.severity,
+            'status': status,
+            'blocking': status != 'ok' and b.severity == 'error',
+            'latency': round(latency, 3),
+            'messages': messages,
+        })
+
+    return results
+
+'''
+Run VZ-specific checkers that look for upgrade blockers.
+Return dictionary with 'blocked' flag, 'duration' of the checks and
+'checks' - list of results of every check, see run_blockers()
+'''
+def list_blockers(opts=None):
+    if opts is None:
+        opts = make_options('check')
+    start = time.time()
+    results = run_blockers(opts)
+    return {'blocked': any(r['blocking'] for r in results),
+            'duration': round(time.time() - start, 3),
+            'checks': results}
+
+'''
+Print blocker report in the format chosen by --format.
+Return 1 if the upgrade is blocked
+'''
+def print_blockers(opts, report):
+    if getattr(opts, 'format', 'text') == 'json':
+        out = getattr(opts, 'json_stream', sys.stdout)
+        print(json.dumps({k: report[k] for k in ['blocked', 'duration', 'checks']}, indent=4), file=out)
+        out.flush()
+        return 1 if report['blocked'] else 0
+
+    for r in report['checks']:
+        for m in r['messages']:
+            print(m)
+
+    if not report['blocked']:
         print("No upgrade blockers found!")
         return 0
     else:
         print("Critical blockers found, please fix them before trying to upgrade")
         return 1
 
+'''
+Explicitely launch VZ-specific checkers that check for upgrade blockers
+'''
+@traced_phase
+def check_blockers(opts):
+    return print_blockers(opts, list_blockers(opts))
+
 '''
 Transform build id into an integer number
 '''
@@ -312,157 +1713,1034 @@ def get_build_hash(ver):
 '''
 Check if VA Agent is running
 '''
-def check_va():
+@register_blocker('va')
+def check_va(opts):
     pva_detected = False
     try:
-        proc = subprocess.check_output(["systemctl", "is-active", "va-agent"])
+        proc = traced_check_output(["systemctl", "is-active", "va-agent"])
     except:
-        return 0
+        return []
     for line in proc.split():
         if line is not None and line.decode('utf-8').strip() == "active":
-            print("You have VA agent service running.")
-            print("There is no VA in VHS 8, you won't be able to control the node via VA after upgrade.")
-            print("Please unregister the node or at least stop va-agent service before the upgrade.")
-            return 1
+            return ["You have VA agent service running.",
+                    "There is no VA in VHS 8, you won't be able to control the node via VA after upgrade.",
+                    "Please unregister the node or at least stop va-agent service before the upgrade."]
 
-    return 0
+    return []
 
 '''
 Check if Storage UI Agent is running
 '''
-def check_storage_ui():
+@register_blocker('storage_ui')
+def check_storage_ui(opts):
     pva_detected = False
     try:
-        proc = subprocess.check_output(["systemctl", "is-active", "vstorage-ui-agent"])
+        proc = traced_check_output(["systemctl", "is-active", "vstorage-ui-agent"])
     except:
         # No service - no problems
-        return 0
+        return []
     for line in proc.split():
         if line is not None and line.decode('utf-8').strip() == "active":
-            print("You have Storage UI agent service running.")
-            print("There is no Storage UI in VHS 8, you won't be able to control the node via UI after upgrade.")
-            print("Please unregister the node or at least stop vstorage-ui-agent service before the upgrade.")
-            return 1
+            return ["You have Storage UI agent service running.",
+                    "There is no Storage UI in VHS 8, you won't be able to control the node via UI after upgrade.",
+                    "Please unregister the node or at least stop vstorage-ui-agent service before the upgrade."]
 
-    return 0
+    return []
 
 
+'''
+Stop a single VE, suspended VEs are resumed first.
+If the VE doesn't stop in 'timeout' seconds, it is killed.
+Return the result ('stopped', 'killed' or 'failed') and time spent
+'''
+def stop_ve(name, status, timeout):
+    FNULL = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        if status == "suspended":
+            traced_call(['prlctl', 'start', name], stdout=FNULL, stderr=FNULL, timeout=timeout)
+        ret = traced_call(['prlctl', 'stop', name], stdout=FNULL, stderr=FNULL,
+                              timeout=max(1, timeout - (time.time() - start)))
+        result = 'stopped' if ret == 0 else 'failed'
+    except subprocess.TimeoutExpired:
+        try:
+            ret = traced_call(['prlctl', 'stop', name, '--kill'], stdout=FNULL, stderr=FNULL, timeout=KILL_TIMEOUT)
+            result = 'killed' if ret == 0 else 'failed'
+        except subprocess.TimeoutExpired:
+            result = 'failed'
+    return result, time.time() - start
+
 '''
 Force all VEs to be stopped.
+
+VEs are stopped in parallel, at most opts.stop_jobs at once.
+Return the number of VEs which failed to stop.
 '''
-def stop_ves():
-    proc = subprocess.check_output(["prlctl", "list", "-a", "-o", "status,name"])
+@traced_phase
+def stop_ves(opts):
+    proc = traced_check_output(["prlctl", "list", "-a", "-o", "status,name"])
     if not proc:
-        return
+        return 0
 
-    for line in str(proc).split('\n'):
+    ves = []
+    for line in proc.decode('utf-8').split('\n'):
         if not line.startswith("running") and not line.startswith("suspended"):
             continue
+        # VE names can contain spaces
+        (status, name) = line.strip().split(None, 1)
+        ves.append((status, name))
 
-        (status, name) = line.split()
+    if not ves:
+        return 0
 
-        if status == "running":
-            subprocess.call(['prlctl', 'stop', name])
-        else:
-            subprocess.call(['prlctl', 'start', name])
-            subprocess.call(['prlctl', 'stop', name])
+    print("Stopping %d VEs, %d in parallel..." % (len(ves), opts.stop_jobs))
+    start = time.time()
+    summary = {'stopped': 0, 'killed': 0, 'failed': 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts.stop_jobs) as executor:
+        futures = {executor.submit(stop_ve, name, status, opts.stop_timeout): name for (status, name) in ves}
+        for done, f in enumerate(concurrent.futures.as_completed(futures), 1):
+            (result, duration) = f.result()
+            summary[result] += 1
+            print("[%d/%d] %s: %s in %.1f seconds" % (done, len(ves), futures[f], result, duration))
+            sys.stdout.flush()
+
+    print("Processed %d VEs in %.1f seconds: %d stopped, %d killed, %d failed"
+          % (len(ves), time.time() - start, summary['stopped'], summary['killed'], summary['failed']))
+    return summary['failed']
 
 
 '''
-Save different configuration parameters
+Get the fastest available compressor for archives.
+Return the command compressing stdin to stdout and the archive suffix
 '''
-def save_configs():
-    # Save info about vlans
-    subprocess.call(['mkdir', '-p', '/var/lib/vzupgrade'])
-    iflist = open('/var/lib/vzupgrade/iflist', 'w')
-    subprocess.call(['ip', 'a'], stdout=iflist)
-    iflist.close();
+def get_compressor():
+    if shutil.which('zstd'):
+        return ['zstd', '-q', '-T0', '-c'], '.tar.zst'
+    if shutil.which('pigz'):
+        return ['pigz', '-c'], '.tar.gz'
+    return ['gzip', '-c'], '.tar.gz'
 
-    # Info about services
-    chklist = open('/var/lib/vzupgrade/services', 'w')
-    subprocess.call(['chkconfig', '--list'], stdout=chklist)
-    chklist.close();
+'''
+Archive the whole /etc folder.
 
-    # Archive the whole /etc folder
-    subprocess.call(['tar', 'czf', '/var/lib/vzupgrade/etc.tar.gz', '/etc'])
+Full snapshot is saved as etc.tar.* together with etc.snar, GNU tar
+incremental metadata. Incremental snapshot (etc-incr.tar.*) contains only
+files changed since the last full one, taken by 'vzupgrade check'.
+To restore, extract the full archive and then the incremental one
+with '--listed-incremental=/dev/null'.
+'''
+@traced_phase
+def snapshot_etc(incremental=False):
+    os.makedirs(VZUPGRADE_DIR, exist_ok=True)
+    (compressor, suffix) = get_compressor()
+    snar = os.path.join(VZUPGRADE_DIR, 'etc.snar')
+    base = glob.glob(os.path.join(VZUPGRADE_DIR, 'etc.tar.*'))
+
+    if incremental and os.path.isfile(snar) and base:
+        # Work on a copy of metadata to keep the full snapshot reusable
+        shutil.copyfile(snar, os.path.join(VZUPGRADE_DIR, 'etc-incr.snar'))
+        snar = os.path.join(VZUPGRADE_DIR, 'etc-incr.snar')
+        archive = os.path.join(VZUPGRADE_DIR, 'etc-incr' + suffix)
+    else:
+        for f in glob.glob(os.path.join(VZUPGRADE_DIR, 'etc*.tar.*')) + glob.glob(os.path.join(VZUPGRADE_DIR, 'etc*.snar')):
+            os.remove(f)
+        archive = os.path.join(VZUPGRADE_DIR, 'etc' + suffix)
+
+    tar_cmd = ['tar', '--listed-incremental=' + snar, '-cf', '-', '-C', ROOT, 'etc']
+    with open(archive, 'wb') as out:
+        start = time.time()
+        tar = TracedPopen(tar_cmd, stdout=subprocess.PIPE)
+        comp = TracedPopen(compressor, stdin=tar.stdout, stdout=out)
+        tar.stdout.close()
+        comp.wait()
+        trace_command(compressor, start, comp.returncode, comp)
+        tar.wait()
+        trace_command(tar_cmd, start, tar.returncode, tar)
 
-    if not cmdline.skip_vz:
-        netlist = open('/var/lib/vzupgrade/net_list', 'w')
-        subprocess.call(['prlsrvctl', 'net', 'list'], stdout=netlist)
-        netlist.close();
+'''
+Save output of a command to a file in VZUPGRADE_DIR
+'''
+def save_command_output(cmd, fname):
+    with open(os.path.join(VZUPGRADE_DIR, fname), 'w') as f:
+        traced_call(cmd, stdout=f)
+
+'''
+Save different configuration parameters.
+All captures are independent and are made in parallel.
+'''
+@traced_phase
+def save_configs(opts):
+    os.makedirs(VZUPGRADE_DIR, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            # Save info about vlans, both human-readable and structured one
+            executor.submit(save_command_output, ['ip', 'a'], 'iflist'),
+            executor.submit(save_command_output, ['ip', '-j', 'addr'], 'iflist.json'),
+            # Info about services
+            executor.submit(save_command_output, ['chkconfig', '--list'], 'services'),
+            # Changes in /etc since 'vzupgrade check'
+            executor.submit(snapshot_etc, True),
+        ]
+        if not opts.skip_vz:
+            futures.append(executor.submit(save_command_output, ['prlsrvctl', 'net', 'list'], 'net_list'))
+        for f in futures:
+            f.result()
 
 
 '''
 Actually run upgrade by means of leapp tool
 leapp automatically launces preupgrade if it was not passed yet
 '''
-def install():
-    prepare_files()
-    if check_blockers():
+@traced_phase
+@json_stdout
+def install(opts):
+    prepare_files(opts)
+    if check_blockers(opts):
         return 1
 
-    run_preinstall_hooks()
+    if run_preinstall_hooks():
+        print("Some pre-install hooks have failed, please check their logs in %s" % HOOK_LOG_DIR)
+        return 1
 
     # Clean up rpm __db* files - they can break update process
-    for root, dirs, files in os.walk('/var/lib/rpm/__db*'):
-        for f in files:
-            if f.startswith("__db"):
-                os.remove("/var/lib/rpm/" + f)
+    for f in glob.glob(os.path.join(RPMDB_DIR, '__db*')):
+        os.remove(f)
 
-    d = dict(os.environ)
-    if cmdline.skip_vz:
-        d['SKIPVZ'] = '1'
+    (leapp_cmd, d) = prepare_leapp(opts, 'upgrade')
 
-    if os.path.exists("/etc/leapp/files/repomap.csv"):
-        os.unlink("/etc/leapp/files/repomap.csv")
-    if os.path.exists("/etc/leapp/files/pes-events.json"):
-        os.unlink("/etc/leapp/files/pes-events.json")
+    save_configs(opts)
+    if not opts.skip_vz:
+        stop_ves(opts)
 
-    if cmdline.use_vz9:
-        os.link("/etc/leapp/files/repomap-vz9.csv", "/etc/leapp/files/repomap.csv")
-        os.link("/etc/leapp/files/pes-events-vz9.json", "/etc/leapp/files/pes-events.json")
-        leapp_cmd = ['leapp', 'upgrade',  '--no-rhsm', '--enablerepo=vz9', '--enablerepo=vzlinux9']
-    else:
-        os.link("/etc/leapp/files/repomap-vz8.csv", "/etc/leapp/files/repomap.csv")
-        os.link("/etc/leapp/files/pes-events-vz8.json", "/etc/leapp/files/pes-events.json")
-        leapp_cmd = ['leapp', 'upgrade',  '--no-rhsm', '--enablerepo=vz8', '--enablerepo=vzlinux8']
-    if cmdline.enablerepo:
-        for repo in cmdline.enablerepo:
-            leapp_cmd.append('--enablerepo=' + repo)
+    ret = run_leapp(leapp_cmd, d)
+    if ret:
+        print("leapp upgrade has failed with exit code %d, see the report in %s" % (ret, LEAPP_LOG_DIR))
+        return ret
 
-    if cmdline.debug:
-        leapp_cmd.append('--debug')
-    elif cmdline.verbose:
-        leapp_cmd.append('--verbose')
+    if opts.reboot:
+        traced_call(['reboot'])
+    return 0
 
-    save_configs()
-    if not cmdline.skip_vz:
-        stop_ves()
+'''
+Find mount point of the filesystem containing the given path
+'''
+def find_mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
 
-    subprocess.call(leapp_cmd, env=d)
+'''
+Estimate size of /etc archive made by save_configs(): size of the last
+full snapshot if we have it, or size of /etc itself
+'''
+def estimate_etc_archive():
+    archives = glob.glob(os.path.join(VZUPGRADE_DIR, 'etc.tar.*'))
+    if archives:
+        return os.path.getsize(archives[0])
 
-    if cmdline.reboot:
-        subprocess.call(['reboot'])
+    size = 0
+    for (root, dirs, files) in os.walk(ETC_DIR):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+'''
+Compute space (in bytes) needed for the upgrade in different folders:
+ * downloaded target packages and leapp userspace container in /var/lib/leapp
+ * growth of installed packages in /usr
+ * new kernel and initramfs images in /boot
+ * configuration archive in VZUPGRADE_DIR
+
+Target package sizes are taken from cached metadata of target repositories,
+packages missing there are estimated from their installed sizes
+'''
+def plan_space(opts):
+    (target, _) = index_repo_packages(get_target_repos(opts))
+    by_name = {}
+    for p in target.values():
+        by_name.setdefault(p.name, p)
+
+    download = 0
+    growth = 0
+    for (name, epoch, version, release, arch, size) in read_rpmdb():
+        p = target.get((name, arch)) or by_name.get(name)
+        if p:
+            download += p.size_package
+            growth += p.size_installed - size
+        else:
+            download += int(size * DOWNLOAD_RATIO)
+
+    MB = 1024 * 1024
+    return {
+        host_path('/var/lib/leapp'): max(MIN_FREE_GB * 1024 * MB, LEAPP_USERSPACE_MB * MB + download),
+        host_path('/usr'): max(growth, 0),
+        host_path('/boot'): BOOT_REQUIRED_MB * MB,
+        VZUPGRADE_DIR: estimate_etc_archive(),
+    }
+
+'''
+Match space requirements against filesystems, calling statvfs once per filesystem.
+Return list of (mount point, required bytes, available bytes) for every filesystem
+'''
+def check_filesystems(requirements):
+    filesystems = {}
+    for (path, size) in requirements.items():
+        # Check the nearest existing folder
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        mnt = find_mount_point(path)
+        filesystems[mnt] = filesystems.get(mnt, 0) + size
+
+    result = []
+    for (mnt, size) in sorted(filesystems.items()):
+        st = os.statvfs(mnt)
+        result.append((mnt, size, st.f_bavail * st.f_frsize))
+    return result
 
 # Check if we have enough free space
-def check_space():
-    s = os.statvfs('/var/lib')
-    f = (s.f_bavail * s.f_frsize) / 1024 /1024 / 1024
-    if f < MIN_FREE_GB:
-        print("Insufficient disk space! We need at least %d for /var/lib" % MIN_FREE_GB)
+@register_blocker('space')
+def check_space(opts):
+    MB = 1024 * 1024
+    messages = []
+    for (mnt, required, available) in check_filesystems(plan_space(opts)):
+        if opts.verbose or opts.debug:
+            print("%s: %d MB required, %d MB available" % (mnt, required / MB, available / MB))
+        if required > available:
+            messages.append("Insufficient disk space! %s needs %d MB more (%d MB required, %d MB available)"
+                            % (mnt, (required - available) / MB, required / MB, available / MB))
+    return messages
+
+# Report if the space check has to guess sizes of target packages
+@register_blocker('target_metadata', severity='warning')
+def check_target_metadata(opts):
+    uncached = [r for r in get_target_repos(opts) if not find_repo_metadata(r)]
+    if uncached:
+        return ["No metadata for target repositories %s, disk space is estimated from installed package sizes. "
+                "Run 'vzupgrade prefetch' for a precise estimate" % ", ".join(uncached)]
+    return []
+
+'''
+Get target repositories: vzN, vzlinuxN and ones from --enablerepo
+'''
+def get_target_repos(opts):
+    suf = '9' if opts.use_vz9 else '8'
+    return ['vz' + suf, 'vzlinux' + suf] + (opts.enablerepo or [])
+
+'''
+Get base URLs of a repository from its config, either baseurl or
+mirrorlist is used. Yum variables are expanded for the target release
+'''
+def get_repo_urls(opts, conf):
+    import urllib.request
+    suf = '9' if opts.use_vz9 else '8'
+
+    def expand(url):
+        return url.replace('$releasever', suf).replace('$basearch', os.uname()[4]).strip()
+
+    if conf.get('baseurl'):
+        return [expand(u) for u in conf['baseurl'].split()]
+
+    urls = []
+    if conf.get('mirrorlist'):
+        with urllib.request.urlopen(expand(conf['mirrorlist']), timeout=60) as f:
+            for l in f.read().decode('utf-8').split("\n"):
+                if l.strip() and not l.strip().startswith('#'):
+                    urls.append(expand(l))
+    return urls
+
+'''
+Compute checksum of a file, yum uses 'sha' as an alias for sha1
+'''
+def file_checksum(path, checksum_type):
+    h = hashlib.new('sha1' if checksum_type == 'sha' else checksum_type)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+'''
+Download a file. Partially downloaded file ('.part') is resumed if the server
+supports ranges. If checksum is given, existing file with the right checksum
+is not downloaded again and downloaded file is verified.
+Return the number of downloaded bytes
+'''
+def download_file(url, dest, checksum_type=None, checksum=None):
+    import urllib.error
+    import urllib.request
+    if checksum and os.path.isfile(dest) and file_checksum(dest, checksum_type) == checksum:
+        return 0
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    part = dest + '.part'
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    req = urllib.request.Request(url)
+    if offset and url.startswith('http'):
+        req.add_header('Range', 'bytes=%d-' % offset)
+
+    downloaded = 0
+    try:
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            # Server can ignore our range request
+            mode = 'ab' if offset and getattr(resp, 'status', 200) == 206 else 'wb'
+            with open(part, mode) as f:
+                for chunk in iter(lambda: resp.read(1024 * 1024), b''):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+    except urllib.error.HTTPError as e:
+        # Range past the end: the partial file is already complete,
+        # it is verified by its checksum below
+        if not offset or e.code != 416:
+            raise
+
+    if checksum and file_checksum(part, checksum_type) != checksum:
+        os.remove(part)
+        raise IOError("Checksum mismatch for %s" % url)
+    os.rename(part, dest)
+    return downloaded
+
+'''
+Get path of a package in the prefetch mirror of a repository.
+Locations come from remote metadata, so absolute ones and ones leading
+outside of the mirror (e.g. with '../') are rejected with ValueError
+'''
+def prefetch_path(repoid, location):
+    repo_dir = os.path.normpath(os.path.join(PREFETCH_DIR, repoid))
+    path = os.path.normpath(os.path.join(repo_dir, location))
+    if os.path.isabs(location) or not path.startswith(repo_dir + os.sep):
+        raise ValueError("Package location outside of the repository: %s" % location)
+    return path
+
+'''
+Download repository metadata of a target repo to the prefetch mirror.
+Return the base URL used and path to the downloaded primary metadata
+'''
+def fetch_repo_metadata(opts, repoid, conf):
+    import xml.etree.ElementTree as ET
+    repo_dir = os.path.join(PREFETCH_DIR, repoid)
+    try:
+        urls = get_repo_urls(opts, conf)
+    except (IOError, OSError, ValueError) as e:
+        raise IOError("Failed to get mirror list of %s: %s" % (repoid, e))
+
+    errors = []
+    for url in urls:
+        url = url.rstrip('/') + '/'
+        try:
+            repomd = os.path.join(repo_dir, 'upstream', 'repomd.xml')
+            download_file(url + 'repodata/repomd.xml', repomd)
+            for data in ET.parse(repomd).getroot().iter('{%s}data' % XMLNS_REPO):
+                if data.get('type') == 'primary':
+                    href = data.find('{%s}location' % XMLNS_REPO).get('href')
+                    checksum = data.find('{%s}checksum' % XMLNS_REPO)
+                    primary = os.path.join(repo_dir, 'upstream', os.path.basename(href))
+                    download_file(url + href, primary, checksum.get('type'), checksum.text)
+                    return url, primary
+            errors.append("%s: no primary metadata" % url)
+        except (IOError, OSError, ET.ParseError) as e:
+            errors.append("%s: %s" % (url, e))
+    raise IOError("Failed to get metadata of %s: %s" % (repoid, "; ".join(errors) or "no URLs"))
+
+'''
+Make the prefetch mirror of a repository a valid yum repository containing
+only the downloaded packages: filter primary metadata and write repomd.xml
+'''
+def write_prefetch_repo(repoid, upstream_primary, locations):
+    import gzip
+    import xml.etree.ElementTree as ET
+    repo_dir = os.path.join(PREFETCH_DIR, repoid)
+    os.makedirs(os.path.join(repo_dir, 'repodata'), exist_ok=True)
+    ET.register_namespace('', XMLNS_COMMON)
+    ET.register_namespace('rpm', XMLNS_RPM)
+
+    root = ET.Element('{%s}metadata' % XMLNS_COMMON)
+    with gzip.open(upstream_primary) as f:
+        for (_, elem) in ET.iterparse(f):
+            if elem.tag == '{%s}package' % XMLNS_COMMON and \
+                    elem.find('{%s}location' % XMLNS_COMMON).get('href') in locations:
+                root.append(elem)
+    root.set('packages', str(len(root)))
+
+    primary = os.path.join(repo_dir, 'repodata', 'primary.xml.gz')
+    with gzip.open(primary, 'wb') as f:
+        ET.ElementTree(root).write(f, encoding='UTF-8', xml_declaration=True)
+
+    repomd = ET.Element('{%s}repomd' % XMLNS_REPO)
+    ET.SubElement(repomd, '{%s}revision' % XMLNS_REPO).text = str(int(time.time()))
+    data = ET.SubElement(repomd, '{%s}data' % XMLNS_REPO, type='primary')
+    ET.SubElement(data, '{%s}checksum' % XMLNS_REPO, type='sha256').text = file_checksum(primary, 'sha256')
+    ET.SubElement(data, '{%s}location' % XMLNS_REPO, href='repodata/primary.xml.gz')
+    ET.SubElement(data, '{%s}timestamp' % XMLNS_REPO).text = str(int(os.path.getmtime(primary)))
+    ET.SubElement(data, '{%s}size' % XMLNS_REPO).text = str(os.path.getsize(primary))
+    ET.register_namespace('', XMLNS_REPO)
+    ET.ElementTree(repomd).write(os.path.join(repo_dir, 'repodata', 'repomd.xml'), encoding='UTF-8', xml_declaration=True)
+
+'''
+Register prefetch mirrors of target repositories in yum configuration.
+Mirrors have the same priority as original repos but lower cost, so identical
+packages are taken from them. Return ids of the mirror repositories
+'''
+def enable_prefetched_repos(opts):
+    repos = read_repo_configs()
+    sections = []
+    for repoid in get_target_repos(opts):
+        if not os.path.isfile(os.path.join(PREFETCH_DIR, repoid, 'repodata', 'repomd.xml')):
+            continue
+        conf = repos.get(repoid, {})
+        sections.append("[vzupgrade-prefetch-%s]\nname=Packages of %s prefetched by vzupgrade\n"
+                        "baseurl=file://%s/\nenabled=0\ncost=10\nmodule_hotfixes=1\ngpgcheck=%s\n%s%s\n"
+                        % (repoid, repoid, os.path.join(PREFETCH_DIR, repoid), conf.get('gpgcheck', '1'),
+                           ("priority=%s\n" % conf['priority']) if 'priority' in conf else "",
+                           ("gpgkey=%s\n" % conf['gpgkey']) if 'gpgkey' in conf else ""))
+
+    if not sections:
+        if os.path.isfile(PREFETCH_REPO_FILE):
+            os.remove(PREFETCH_REPO_FILE)
+        return []
+
+    with open(PREFETCH_REPO_FILE, 'w') as f:
+        f.write("\n".join(sections))
+    return ["vzupgrade-prefetch-" + r for r in get_target_repos(opts)
+            if os.path.isfile(os.path.join(PREFETCH_DIR, r, 'repodata', 'repomd.xml'))]
+
+'''
+Download target packages in advance, so that leapp doesn't have to
+download them right before the reboot.
+
+For every installed package, the newest package with the same name
+(and the same architecture, if possible) in target repositories is
+downloaded to a local mirror, which is then used by 'install'.
+Interrupted downloads are resumed on the next run.
+'''
+@traced_phase
+def prefetch(opts):
+    add_repos(opts)
+    repos = read_repo_configs()
+    start = time.time()
+
+    # Resolve target packages
+    newest = {}
+    sources = {}
+    failed_repos = []
+    for repoid in get_target_repos(opts):
+        if repoid not in repos:
+            print("Repository %s is not configured, skipping" % repoid)
+            continue
+        try:
+            (url, primary) = fetch_repo_metadata(opts, repoid, repos[repoid])
+            packages = read_repo_metadata(primary)
+        except (IOError, OSError, ValueError) as e:
+            print("Skipping repository %s: %s" % (repoid, e))
+            failed_repos.append(repoid)
+            continue
+        sources[repoid] = (url, primary)
+        for p in packages:
+            old = newest.get((p.name, p.arch))
+            if not old or compare_evr((p.epoch, p.version, p.release), (old[1].epoch, old[1].version, old[1].release)) > 0:
+                newest[(p.name, p.arch)] = (repoid, p)
+
+    by_name = {}
+    for (repoid, p) in newest.values():
+        by_name.setdefault(p.name, (repoid, p))
+    wanted = {}
+    missing = 0
+    for (name, epoch, version, release, arch, size) in read_rpmdb():
+        target = newest.get((name, arch)) or by_name.get(name)
+        if target:
+            wanted[(target[0], target[1].location)] = target
+        else:
+            missing += 1
+
+    print("Resolved %d target packages in %.1f seconds, %d installed packages have no counterparts in target repositories"
+          % (len(wanted), time.time() - start, missing))
+
+    # Download them in parallel
+    start = time.time()
+    total = sum(p.size_package for (repoid, p) in wanted.values())
+    done = {'bytes': 0, 'cached': 0, 'failed': 0}
+    locations = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts.jobs) as executor:
+        futures = {}
+        for (repoid, p) in wanted.values():
+            try:
+                path = prefetch_path(repoid, p.location)
+            except ValueError as e:
+                done['failed'] += 1
+                print("Skipping package of %s: %s" % (repoid, e))
+                continue
+            f = executor.submit(download_file, sources[repoid][0] + p.location,
+                                path, p.checksum_type, p.checksum)
+            futures[f] = (repoid, p)
+        for (n, f) in enumerate(concurrent.futures.as_completed(futures), 1):
+            (repoid, p) = futures[f]
+            try:
+                size = f.result()
+                done['bytes'] += size
+                if not size:
+                    done['cached'] += 1
+                locations.setdefault(repoid, set()).add(p.location)
+            except (IOError, OSError) as e:
+                done['failed'] += 1
+                print("Failed to download %s: %s" % (p.location, e))
+            if n % 100 == 0 or n == len(futures):
+                elapsed = time.time() - start
+                print("[%d/%d] %.1f of %.1f MB downloaded, %.1f MB/s"
+                      % (n, len(futures), done['bytes'] / 1048576.0, total / 1048576.0, done['bytes'] / 1048576.0 / max(elapsed, 0.001)))
+                sys.stdout.flush()
+
+    for (repoid, (url, primary)) in sources.items():
+        write_prefetch_repo(repoid, primary, locations.get(repoid, set()))
+
+    print("Prefetch finished in %.1f seconds: %d packages already cached, %d failed"
+          % (time.time() - start, done['cached'], done['failed']))
+    if failed_repos:
+        print("Failed to get metadata of repositories: %s" % ", ".join(failed_repos))
+    return 1 if done['failed'] or failed_repos else 0
+
+'''
+Read trace events of the given run ('last' for the latest one, None for all runs)
+'''
+def read_trace(run):
+    events = []
+    try:
+        with open(TRACE_FILE) as f:
+            for l in f:
+                try:
+                    events.append(json.loads(l))
+                except ValueError:
+                    continue
+    except (IOError, OSError):
+        return []
+
+    if run == 'last' and events:
+        run = events[-1]['run']
+    if run:
+        events = [e for e in events if e['run'] == run]
+    return events
+
+'''
+Save trace events in Chrome trace format (chrome://tracing, Perfetto)
+'''
+def write_chrome_trace(events, path):
+    trace = [{'name': e['name'], 'cat': e['type'], 'ph': 'X',
+              'ts': int(e['start'] * 1000000), 'dur': int(e['duration'] * 1000000),
+              'pid': e['pid'], 'tid': e['tid'],
+              'args': {k: v for (k, v) in e.items() if k not in ['name', 'type', 'start', 'duration', 'pid', 'tid']}}
+             for e in events]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+'''
+Print the slowest phases and commands recorded in the trace
+'''
+def report_timings(opts):
+    events = read_trace(None if opts.all else (opts.run or 'last'))
+    if not events:
+        print("No timings recorded in %s" % TRACE_FILE)
         return 1
+
+    if opts.chrome_trace:
+        write_chrome_trace(events, opts.chrome_trace)
+
+    stats = {}
+    for e in events:
+        st = stats.setdefault((e['type'], e['name']), {'count': 0, 'total': 0.0, 'max': 0.0, 'cpu': 0.0, 'rss': 0})
+        st['count'] += 1
+        st['total'] += e['duration']
+        st['max'] = max(st['max'], e['duration'])
+        st['cpu'] += e.get('cpu_user', 0) + e.get('cpu_sys', 0)
+        st['rss'] = max(st['rss'], e.get('maxrss_kb', 0))
+
+    runs = sorted(set(e['run'] for e in events))
+    print("Timings of %s" % (("run " + runs[0]) if len(runs) == 1 else ("%d runs" % len(runs))))
+    print("%-8s %-32s %6s %10s %10s %10s %10s" % ("TYPE", "NAME", "COUNT", "TOTAL,s", "MAX,s", "CPU,s", "RSS,MB"))
+    for ((kind, name), st) in sorted(stats.items(), key=lambda x: -x[1]['total'])[:opts.top]:
+        print("%-8s %-32s %6d %10.2f %10.2f %10.2f %10.1f"
+              % (kind, name[:32], st['count'], st['total'], st['max'], st['cpu'], st['rss'] / 1024.0))
     return 0
 
-def list_prereq():
+'''
+Read fleet inventory: one node per line, optionally followed by
+key=value options used by transports. Empty lines and lines
+starting with '#' are skipped.
+Return list of (node, options)
+'''
+def read_inventory(path):
+    nodes = []
+    seen = set()
+    with open(path) as f:
+        for l in f:
+            fields = l.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if fields[0] in seen:
+                print("Node %s is listed several times in the inventory, skipping duplicates" % fields[0])
+                continue
+            seen.add(fields[0])
+            options = dict(o.split('=', 1) for o in fields[1:] if '=' in o)
+            nodes.append((fields[0], options))
+    return nodes
+
+'''
+Fleet transports: functions returning the command launching vzupgrade
+with the given arguments on a node and its environment (None to inherit ours).
+
+ssh options: user, port, vzupgrade (path to vzupgrade on the node).
+local options: root (VZUPGRADE_ROOT), path (folder prepended to PATH).
+The local transport runs this vzupgrade on the current machine, it is
+intended for testing with nodes simulated by vzupgrade-sim.py
+'''
+def ssh_transport(node, options, args):
+    cmd = ['ssh', '-o', 'BatchMode=yes']
+    if 'port' in options:
+        cmd += ['-p', options['port']]
+    if 'user' in options:
+        cmd += ['-l', options['user']]
+    remote = [options.get('vzupgrade', 'vzupgrade')] + args
+    return cmd + [node, " ".join(shlex.quote(a) for a in remote)], None
+
+def local_transport(node, options, args):
+    env = dict(os.environ)
+    if 'root' in options:
+        env['VZUPGRADE_ROOT'] = options['root']
+    if 'path' in options:
+        env['PATH'] = options['path'] + os.pathsep + env.get('PATH', '')
+    return [sys.executable, os.path.abspath(__file__)] + args, env
+
+FLEET_TRANSPORTS = {
+    'ssh': ssh_transport,
+    'local': local_transport,
+}
+
+'''
+Extract blocker report printed in JSON format from vzupgrade output.
+Return None if there is no report
+'''
+def parse_blocker_report(output):
+    pos = output.find('{\n')
+    while pos >= 0:
+        try:
+            (report, _) = json.JSONDecoder().raw_decode(output, pos)
+            if isinstance(report, dict) and 'checks' in report:
+                return report
+        except ValueError:
+            pass
+        pos = output.find('{\n', pos + 1)
+    return None
+
+'''
+Run vzupgrade with the given arguments on a node, saving its output to log_dir.
+Return result of the node for the fleet report
+'''
+def run_fleet_node(transport, node, options, args, log_dir, timeout):
+    (cmd, env) = transport(node, options, args)
+    log = os.path.join(log_dir, node.replace('/', '_') + '.log')
+    result = {'node': node, 'exit_code': None, 'log': log}
+    start = time.time()
+    try:
+        with open(log, 'w') as f:
+            ret = traced_call(cmd, env=env, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT,
+                              timeout=timeout or None)
+        result['exit_code'] = ret
+        if ret == 0:
+            result['status'] = 'ok'
+        elif ret == 255 and transport == ssh_transport:
+            result['status'] = 'unreachable'
+        else:
+            result['status'] = 'failed'
+    except subprocess.TimeoutExpired:
+        result['status'] = 'timeout'
+    except OSError as e:
+        result['status'] = 'error'
+        with open(log, 'a') as f:
+            f.write("Failed to launch %s: %s\n" % (cmd[0], e))
+    result['duration'] = round(time.time() - start, 1)
+
+    with open(log, errors='replace') as f:
+        output = f.read()
+    report = parse_blocker_report(output)
+    if report:
+        if report['blocked'] and result['status'] == 'failed':
+            result['status'] = 'blocked'
+        result['blockers'] = [{'name': c['name'], 'severity': c['severity'], 'status': c['status'],
+                               'messages': c['messages']} for c in report['checks'] if c['status'] != 'ok']
+    result['tail'] = output.splitlines()[-FLEET_TAIL_LINES:]
+    return result
+
+'''
+Run vzupgrade action on all nodes from the inventory.
+
+At most opts.jobs nodes are processed at once, a new node is started as
+soon as a previous one finishes. When the number of failed nodes exceeds
+the failure budget, no more nodes are started and the remaining ones are
+reported as skipped. Results of all nodes are saved to a single JSON report
+'''
+def fleet(opts):
+    nodes = read_inventory(opts.inventory)
+    if not nodes:
+        print("No nodes found in %s" % opts.inventory)
+        return 1
+
+    args = FLEET_ACTIONS[opts.action] + shlex.split(opts.args or '')
+    transport = FLEET_TRANSPORTS[opts.transport]
+    # By default a failed node stops upgrade of the others, but not checks
+    max_failures = opts.max_failures
+    if max_failures is None:
+        max_failures = 0 if opts.action == 'install' else len(nodes)
+
+    log_dir = os.path.join(FLEET_LOG_DIR, trace_run)
+    os.makedirs(log_dir, exist_ok=True)
+
+    print("Running '%s' on %d nodes, %d at once, failure budget is %d"
+          % (" ".join(args), len(nodes), opts.jobs, max_failures))
+    sys.stdout.flush()
+    start = time.time()
+    results = {}
+    failures = 0
+    pending = list(nodes)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts.jobs) as executor:
+        while pending or running:
+            while pending and len(running) < opts.jobs and failures <= max_failures:
+                (node, options) = pending.pop(0)
+                running[executor.submit(run_fleet_node, transport, node, options, args, log_dir, opts.timeout)] = node
+            if not running:
+                break
+            (done, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                node = running.pop(f)
+                results[node] = f.result()
+                if results[node]['status'] != 'ok':
+                    failures += 1
+                print("[%d/%d] %s: %s in %s" % (len(results), len(nodes), node, results[node]['status'],
+                                                format_duration(results[node]['duration'])))
+                sys.stdout.flush()
+
+    if pending:
+        print("Failure budget is exhausted, %d nodes are skipped" % len(pending))
+    for (node, options) in pending:
+        results[node] = {'node': node, 'status': 'skipped', 'exit_code': None}
+
+    summary = collections.Counter(r['status'] for r in results.values())
+    report = {
+        'run': trace_run,
+        'action': opts.action,
+        'args': args,
+        'transport': opts.transport,
+        'duration': round(time.time() - start, 1),
+        'max_failures': max_failures,
+        'aborted': bool(pending),
+        'summary': dict(summary),
+        'nodes': [results[node] for (node, options) in nodes],
+    }
+    report_file = opts.report or os.path.join(log_dir, 'report.json')
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print("Processed %d nodes in %s: %s" % (len(nodes), format_duration(report['duration']),
+                                           ", ".join("%d %s" % (n, s) for (s, n) in sorted(summary.items()))))
+    print("Report is saved to %s, output of every node is in %s" % (report_file, log_dir))
+    return 0 if summary['ok'] == len(nodes) else 1
+
+'''
+Folders watched by 'vzupgrade watch' and checks affected by changes in them.
+Return dictionary {folder: [check name, ...]}
+'''
+def watch_triggers():
+    triggers = {
+        YUM_REPOS_DIR: ['updates', 'space', 'target_metadata'],
+        RPMDB_DIR: ['updates', 'space'],
+        VZ_CONF_DIR: ['templates'],
+        LEAPP_FILES_DIR: ['hardware_removed', 'hardware_deprecated'],
+        SYSTEMD_UNITS_DIR: ['va', 'storage_ui'],
+        VZUPGRADE_SHARE_DIR: ['templates'],
+    }
+    # Metadata caches of repositories, updated by 'yum makecache'
+    for d in glob.glob(os.path.join(YUM_CACHE_DIR, '*', '*', '*', 'gen')) + glob.glob(os.path.join(DNF_CACHE_DIR, '*', 'repodata')):
+        triggers[d] = ['updates', 'space']
+    # Target metadata downloaded by 'vzupgrade prefetch'
+    for d in glob.glob(os.path.join(PREFETCH_DIR, '*', 'upstream')):
+        triggers[d] = ['space', 'target_metadata']
+    return triggers
+
+'''
+Start watching the given folders with inotify, missing folders are skipped.
+Return inotify file descriptor and dictionary {watch descriptor: folder}
+'''
+def inotify_watch(paths):
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1: %s" % os.strerror(ctypes.get_errno()))
+
+    wds = {}
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            print("Failed to watch %s: %s" % (path, os.strerror(ctypes.get_errno())))
+            continue
+        wds[wd] = path
+    return fd, wds
+
+'''
+Read pending inotify events.
+Return the set of watch descriptors of folders where something has changed
+'''
+def inotify_read(fd):
+    import struct
+    changed = set()
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return changed
+
+    # struct inotify_event: int wd, uint32 mask, cookie, len, followed by len bytes of name
+    pos = 0
+    while pos + 16 <= len(data):
+        (wd, mask, cookie, length) = struct.unpack_from('iIII', data, pos)
+        changed.add(wd)
+        pos += 16 + length
+    return changed
+
+'''
+Serve the current blocker state to every client connected to the UNIX socket.
+The state is kept serialized, so that a request costs the same for any number of checks
+'''
+def serve_watch_socket(sock, served):
+    while True:
+        (conn, _) = sock.accept()
+        with conn:
+            try:
+                conn.sendall(served['data'])
+            except OSError:
+                pass
+
+'''
+Keep state of upgrade blockers up to date.
+
+All checks are run once, then only the checks affected by changes in watched
+folders (see watch_triggers()) are re-run. Checks whose inputs can't be watched
+(WATCH_POLLED) are re-run every opts.interval seconds. The state is saved to
+opts.status_file and sent to every client connecting to opts.socket
+'''
+def watch(opts):
+    import select
+    import signal
+    import socket
+
+    # The service runs checks forever, recording them would grow the trace
+    # endlessly and hide the last real check or install run
+    trace_disabled.set()
+
+    # Stop gracefully when the service is stopped, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    state = {}
+    served = {'data': b''}
+
+    def publish():
+        checks = [state[b.name] for b in BLOCKERS if b.name in state]
+        report = {'blocked': any(r['blocking'] for r in checks), 'updated': round(time.time(), 1),
+                  'pid': os.getpid(), 'checks': checks}
+        data = (json.dumps(report) + "\n").encode('utf-8')
+        served['data'] = data
+        try:
+            os.makedirs(os.path.dirname(opts.status_file), exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(opts.status_file))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, opts.status_file)
+        except (IOError, OSError) as e:
+            print("Failed to save %s: %s" % (opts.status_file, e))
+
+    def refresh(names):
+        for r in run_blockers(opts, names):
+            r['updated'] = round(time.time(), 1)
+            old = state.get(r['name'])
+            if not old or old['status'] != r['status']:
+                print("%s: %s -> %s" % (r['name'], old['status'] if old else 'unknown', r['status']))
+            state[r['name']] = r
+        publish()
+        sys.stdout.flush()
+
+    refresh(None)
+
+    sock = None
+    if opts.socket:
+        if os.path.exists(opts.socket):
+            os.remove(opts.socket)
+        os.makedirs(os.path.dirname(opts.socket), exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(opts.socket)
+        sock.listen(16)
+        threading.Thread(target=serve_watch_socket, args=(sock, served), daemon=True).start()
+
+    triggers = watch_triggers()
+    (fd, wds) = inotify_watch(sorted(triggers))
+    print("Watching %s, polling every %d seconds" % (", ".join(sorted(wds.values())), opts.interval))
+    sys.stdout.flush()
+
+    pending = set()
+    deadline = None
+    next_poll = time.time() + opts.interval
+    try:
+        while True:
+            timeout = min(next_poll, deadline or next_poll) - time.time()
+            (ready, _, _) = select.select([fd], [], [], max(0, timeout))
+            if ready:
+                # Checks run once changes settle down: every new event postpones them
+                for wd in inotify_read(fd):
+                    if wd in wds:
+                        pending.update(triggers[wds[wd]])
+                        deadline = time.time() + WATCH_DEBOUNCE
+
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                (names, pending, deadline) = (pending, set(), None)
+                refresh(names)
+            if now >= next_poll:
+                refresh(WATCH_POLLED)
+                next_poll = now + opts.interval
+    finally:
+        os.close(fd)
+        if sock:
+            sock.close()
+            os.remove(opts.socket)
+
+def list_prereq(opts):
     print("=== Virtuozzo-specific upgrade prerequisites: ===")
     print("* There are no templates for OSes not supported by Vz8")
     print("* All updates are installed")
-    print("* /var/lib has at least %d Gb of free space" % MIN_FREE_GB)
+    print("* Filesystems have enough free space for the downloaded and upgraded packages,")
+    print("  leapp data (at least %d Gb in /var/lib), new kernel images and configuration backup" % MIN_FREE_GB)
+    print("* No devices or drivers removed in the target release are used")
 #    print("* No Virtuozzo Automation packages are installed")
 
 
-def parse_command_line():
-    global cmdline
+'''
+Argument type for numbers of parallel jobs and intervals
+'''
+def positive_int(value):
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: '%s'" % value)
+    if n <= 0:
+        raise argparse.ArgumentTypeError("must be a positive number: '%s'" % value)
+    return n
+
+'''
+Create parser of vzupgrade command line
+'''
+def build_parser():
     parser = argparse.ArgumentParser(description="Virtuozzo Upgrade Tool. Please launch 'vzupgrade <cmd> --help' to get help for a particular command")
     subparsers = parser.add_subparsers(title='command')
 
@@ -473,6 +2751,10 @@ def parse_command_line():
     sp.add_argument('--enablerepo', nargs='*', action='store', help='id of additional repository to attach during upgrade. You can specify multiple repos here, e.g. "--enablerepo r1 r2 r3". Repositories should be already present in yum configuration files')
     sp.add_argument('--verbose', action='store_true', help='Print all but debug log messages (info, warning, error, critical) to stderr. By default only error and critical level messages are printed.')
     sp.add_argument('--debug', action='store_true', help='Print all available log messages (debug, info, warning, error, critical) and the output of executed commands to stderr. By default only error and critical level messages are printed.')
+    sp.add_argument('--no-pes-filter', action='store_true', help='Pass the full set of PES events to leapp instead of the events relevant for installed packages')
+    sp.add_argument('--refresh', action='store_true', help='Refresh yum metadata before checking for available updates. By default only cached metadata is used')
+    sp.add_argument('--format', choices=['text', 'json'], default='text', help='Format of the upgrade blockers report. "json" prints every check with its severity, status and latency')
+    sp.add_argument('--force', action='store_true', help='Run leapp preupgrade even if nothing has changed since the last successful check')
     sp.set_defaults(func=check)
 
     sp = subparsers.add_parser('list', help='list prerequisites for in-place upgrade')
@@ -484,8 +2766,13 @@ def parse_command_line():
     sp.add_argument('--use-vz9', action='store_true', help='Upgrade directly to VHS 9')
     sp.add_argument('--enablerepo', nargs='*', action='store', help='id of additional repository to attach during upgrade. You can specify multiple repos here, e.g. "--enablerepo r1 r2 r3". Repositories should be already present in yum configuration files')
     sp.add_argument('--reboot', action='store_true', help='Automatically reboot to start the upgrade when ready')
+    sp.add_argument('--stop-jobs', type=positive_int, default=STOP_JOBS, help='Number of VEs to stop in parallel before the upgrade (default: %d)' % STOP_JOBS)
+    sp.add_argument('--stop-timeout', type=positive_int, default=STOP_TIMEOUT, help='Time in seconds given to a VE to stop gracefully before it is killed (default: %d)' % STOP_TIMEOUT)
     sp.add_argument('--verbose', action='store_true', help='Print all but debug log messages (info, warning, error, critical) to stderr. By default only error and critical level messages are printed.')
     sp.add_argument('--debug', action='store_true', help='Print all available log messages (debug, info, warning, error, critical) and the output of executed commands to stderr. By default only error and critical level messages are printed.')
+    sp.add_argument('--no-pes-filter', action='store_true', help='Pass the full set of PES events to leapp instead of the events relevant for installed packages')
+    sp.add_argument('--refresh', action='store_true', help='Refresh yum metadata before checking for available updates. By default only cached metadata is used')
+    sp.add_argument('--format', choices=['text', 'json'], default='text', help='Format of the upgrade blockers report. "json" prints every check with its severity, status and latency')
 #    sp.add_argument('--clean-cache', action='store_true', help='clean downloaded packages cache')
 #    sp.add_argument('--skip-post-update', action='store_true', help='do not run "yum update" after upgrade is performed and do not enabled readykernel autoupdate')
 #    sp.add_argument('--disable-rk-autoupdate', action='store_true', help='disable ReadyKernel autoupdate in the upgraded system (autoupdate is enabled by default)')
@@ -496,15 +2783,78 @@ def parse_command_line():
 #                            help='Skip license upgrade. WARNING: You will not be able to launch any VM or container in the upgraded system until you enter a valid license!')
     sp.set_defaults(func=install)
 
-    cmdline = parser.parse_args(sys.argv[1:])
-    if not hasattr(cmdline, "func"):
-        cmdline.func = install
+    sp = subparsers.add_parser('prefetch', help='Download target packages in advance to shorten the upgrade')
+    sp.add_argument('--skip-vz', action='store_true', help='Skip VZ-specific actions')
+    sp.add_argument('--use-vz9', action='store_true', help='Upgrade directly to VHS 9')
+    sp.add_argument('--enablerepo', nargs='*', action='store', help='id of additional repository to attach during upgrade. You can specify multiple repos here, e.g. "--enablerepo r1 r2 r3". Repositories should be already present in yum configuration files')
+    sp.add_argument('--jobs', type=positive_int, default=PREFETCH_JOBS, help='Number of parallel downloads (default: %d)' % PREFETCH_JOBS)
+    sp.set_defaults(func=prefetch)
+
+    sp = subparsers.add_parser('report-timings', help='Summarize the slowest phases and commands of vzupgrade runs')
+    sp.add_argument('--run', action='store', help='id of the run to report (default: the last one)')
+    sp.add_argument('--all', action='store_true', help='Report all recorded runs together')
+    sp.add_argument('--top', type=int, default=20, help='Number of entries to print (default: 20)')
+    sp.add_argument('--chrome-trace', action='store', metavar='FILE', help='Also save reported events in Chrome trace format to FILE')
+    sp.set_defaults(func=report_timings)
+
+    sp = subparsers.add_parser('fleet', help='Check or upgrade many nodes with limited concurrency')
+    sp.add_argument('inventory', help='File with nodes to process, one per line, optionally followed by key=value transport options')
+    sp.add_argument('--action', choices=sorted(FLEET_ACTIONS), default='blocker', help='What to run on the nodes: "blocker" (check --blocker), "check" or "install" (default: blocker)')
+    sp.add_argument('--args', action='store', help='Additional vzupgrade arguments for the nodes, e.g. "--use-vz9 --reboot"')
+    sp.add_argument('--jobs', type=positive_int, default=FLEET_JOBS, help='Number of nodes processed in parallel (default: %d)' % FLEET_JOBS)
+    sp.add_argument('--max-failures', type=int, help='Number of failed nodes after which no more nodes are started (default: 0 for install, unlimited for checks)')
+    sp.add_argument('--timeout', type=int, default=0, help='Max time in seconds given to a node, 0 means no limit (default: 0)')
+    sp.add_argument('--transport', choices=sorted(FLEET_TRANSPORTS), default='ssh', help='How to launch vzupgrade on the nodes (default: ssh)')
+    sp.add_argument('--report', action='store', metavar='FILE', help='Save the aggregated JSON report to FILE (default: %s/<run>/report.json)' % FLEET_LOG_DIR)
+    sp.set_defaults(func=fleet)
+
+    sp = subparsers.add_parser('templates', help='Report OS templates of containers and their support in the target release')
+    sp.add_argument('--use-vz9', action='store_true', help='Upgrade directly to VHS 9')
+    sp.add_argument('--format', choices=['text', 'json'], default='text', help='Format of the report')
+    sp.add_argument('--verbose', action='store_true', help='Print containers of every template')
+    sp.add_argument('--debug', action='store_true', help='Print containers of every template')
+    sp.set_defaults(func=report_templates)
+
+    sp = subparsers.add_parser('watch', help='Keep state of upgrade blockers up to date for monitoring tools')
+    sp.add_argument('--skip-vz', action='store_true', help='Skip VZ-specific actions')
+    sp.add_argument('--use-vz9', action='store_true', help='Upgrade directly to VHS 9')
+    sp.add_argument('--enablerepo', nargs='*', action='store', help='id of additional repository to attach during upgrade. You can specify multiple repos here, e.g. "--enablerepo r1 r2 r3". Repositories should be already present in yum configuration files')
+    sp.add_argument('--verbose', action='store_true', help='Print details of the checks')
+    sp.add_argument('--debug', action='store_true', help='Print details of the checks')
+    sp.add_argument('--interval', type=positive_int, default=WATCH_INTERVAL, help='Interval in seconds between re-runs of checks which can\'t be watched: disk space and services (default: %d)' % WATCH_INTERVAL)
+    sp.add_argument('--status-file', default=WATCH_STATUS_FILE, help='File to keep the state in (default: %s)' % WATCH_STATUS_FILE)
+    sp.add_argument('--socket', default=WATCH_SOCKET, help='UNIX socket sending the state to every connected client, empty string disables it (default: %s)' % WATCH_SOCKET)
+    sp.set_defaults(func=watch, refresh=False)
+
+    return parser
+
+'''
+Parse command line arguments (sys.argv by default).
+Options of the command are passed to all functions explicitly
+'''
+def parse_command_line(args=None):
+    opts = build_parser().parse_args(sys.argv[1:] if args is None else args)
+    if not hasattr(opts, "func"):
+        opts.func = install
+    return opts
+
+'''
+Create options for API calls: defaults of the given vzupgrade command
+overridden by keyword arguments, e.g. make_options('check', use_vz9=True)
+'''
+def make_options(command='check', **kwargs):
+    opts = parse_command_line([command])
+    for (k, v) in kwargs.items():
+        if not hasattr(opts, k):
+            raise TypeError("Unknown option of '%s' command: %s" % (command, k))
+        setattr(opts, k, v)
+    return opts
 
 
 if __name__ == '__main__':
-    parse_command_line()
+    opts = parse_command_line()
 
     try:
-        cmdline.func()
+        sys.exit(opts.func(opts))
     except KeyboardInterrupt:
         sys.exit(0)